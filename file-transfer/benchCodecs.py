@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+# Throughput against compression ratio for each stream codec over a
+# bandwidth-limited loopback link (a socketpair whose sender is paced).
+
+import os, random, socket, sys, threading, time
+sys.path.append("../lib")       # for params
+import params
+import framing
+
+switchesVarDefaults = (
+    (('-m', '--megabytes'), 'megabytes', 32),
+    (('-b', '--bandwidth'), 'bandwidth', 50), # link speed in MB/s
+    (('-k', '--kind'), 'kind', "text"), # text (logs and CSV) or random
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+class PacedSock: # sendall that never goes faster than the simulated link
+    def __init__(self, sock, rate):
+        self.sock, self.rate = sock, rate
+        self.sent, self.start = 0, time.perf_counter()
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+        ahead = self.start + self.sent / self.rate - time.perf_counter()
+        if ahead > 0:
+            time.sleep(ahead)
+
+class NullFile:
+    def write(self, data):
+        return len(data)
+
+class MemFile: # the sender's source file, held in memory so disk speed doesn't matter
+    def __init__(self, data):
+        self.data, self.pos = data, 0
+    def read(self, n):
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+    def tell(self):
+        return self.pos
+    def seek(self, pos):
+        self.pos = pos
+
+def make_data(kind, size):
+    if kind == "random":
+        return os.urandom(size)
+    rng = random.Random(1)
+    levels = ["INFO", "WARN", "ERROR", "DEBUG"]
+    lines = []
+    total = 0
+    while total < size:
+        if rng.random() < 0.5:
+            line = "2025-04-%02d %02d:%02d:%02d %s worker-%d request %d took %dms\n" % (
+                rng.randint(1, 30), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                rng.choice(levels), rng.randint(1, 16), rng.randint(0, 10**6), rng.randint(1, 5000))
+        else:
+            line = "%d,%s,%.4f,%d,%s\n" % (rng.randint(0, 10**6), rng.choice(levels),
+                                          rng.random() * 1000, rng.randint(0, 99), "x" * rng.randint(0, 20))
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+def run(data, codec, rate): # returns (seconds, bytes on the wire)
+    a, b = socket.socketpair()
+    paced = PacedSock(a, rate)
+    result = []
+    receiver = threading.Thread(target=lambda: result.append(framing.recv_stream(b, NullFile())))
+    receiver.start()
+    start = time.perf_counter()
+    framing.send_stream(paced, MemFile(data), len(data), use_sendfile=False, codec=codec)
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    a.close()
+    b.close()
+    assert result == [len(data)]
+    return elapsed, paced.sent
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+size = int(paramMap['megabytes']) << 20
+rate = float(paramMap['bandwidth']) * (1 << 20)
+data = make_data(paramMap['kind'], size)
+
+print(f"{len(data) >> 20} MB of {paramMap['kind']} over a {paramMap['bandwidth']} MB/s link")
+for codec in [None] + list(framing.CODECS):
+    elapsed, wire = run(data, codec, rate)
+    print(f"{codec or 'none':>6}: ratio {len(data) / wire:6.2f}  {len(data) / elapsed / (1 << 20):8.1f} MB/s effective")
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+
+# Load generator for the file transfer servers.
+# Starts one server locally in a scratch directory filled with files whose
+# sizes follow a distribution, then forks concurrent clients that each keep
+# one connection busy with a weighted mix of LIST, GET and PUT for a fixed
+# time. Reports throughput, latency percentiles and the server's cpu and peak
+# RSS, and appends the same numbers as one JSON line to a results file so
+# runs of different server modes can be compared over time.
+
+import json, os, random, signal, socket, subprocess, sys, tempfile, time
+sys.path.append("../lib")       # for params
+import params
+import framing
+
+switchesVarDefaults = (
+    (('-s', '--server'), 'server', "thread"), # thread, select, async or prefork
+    (('-w', '--workers'), 'workers', os.cpu_count() or 1), # prefork worker processes
+    (('-c', '--clients'), 'clients', 16),
+    (('-d', '--duration'), 'duration', 10), # seconds
+    (('-m', '--mix'), 'mix', "LIST:1,GET:8,PUT:1"), # relative weights of each request
+    (('-z', '--sizes'), 'sizes', "4K:70,64K:20,1M:9,16M:1"), # file size distribution, size:weight
+    (('-f', '--files'), 'files', 200), # files on the server before the run
+    (('-p', '--port'), 'port', 50099),
+    (('-o', '--output'), 'output', "benchLoad.jsonl"), # JSON lines, one per run
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIB = os.path.join(HERE, "..", "lib")
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+PERCENTILES = (0.5, 0.99, 0.999)
+
+def server_command(mode, port, workers):
+    if mode == "thread": # no command line of its own: set PORT and call main
+        return [sys.executable, "-c", f"import sys; sys.path.insert(0, {HERE!r}); "
+                f"import framedThreadServer as s; s.PORT = {port}; s.main()"]
+    if mode == "select":
+        return [sys.executable, os.path.join(HERE, "framedSelectServer.py"), "-l", str(port)]
+    if mode == "prefork":
+        return [sys.executable, os.path.join(HERE, "framedSelectServer.py"), "-l", str(port), "-w", str(workers)]
+    if mode == "async":
+        return [sys.executable, os.path.join(HERE, "framedAsyncServer.py"), "-l", str(port)]
+    raise ValueError(f"unknown server mode {mode}")
+
+def parse_weights(spec, value=str): # "a:3,b:1" -> ([value(a), value(b)], [3, 1])
+    items, weights = [], []
+    for part in spec.split(","):
+        item, sep, weight = part.partition(":")
+        items.append(value(item.strip()))
+        weights.append(float(weight) if sep else 1.0)
+    return items, weights
+
+def parse_size(text): # 4K, 1M, 512 ...
+    text = text.upper()
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+class NullFile: # GET bodies are counted, not stored, so client disks stay out of the measurement
+    def write(self, data):
+        return len(data)
+
+def wait_for_server(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def client(n, port, deadline, names, mix, sizes, sources): # one simulated client; returns its tallies
+    rng = random.Random(n)
+    ops = {kind: [] for kind in mix[0]}   # kind -> latencies in seconds
+    moved, errors = 0, 0
+    sink = NullFile()
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        puts = 0
+        while time.monotonic() < deadline:
+            kind = rng.choices(*mix)[0]
+            start = time.perf_counter()
+            if kind == "LIST":
+                framing.send_framed(sock, b"LIST")
+                ok = framing.recv_framed(sock) is not None
+            elif kind == "GET":
+                framing.send_framed(sock, f"GET {rng.choice(names)}".encode())
+                status = framing.recv_framed(sock)
+                received = framing.recv_stream(sock, sink) if status is not None and status.startswith(b"OK") else None
+                ok = received is not None
+                moved += received or 0
+            else: # PUT overwrites one of a small set of names per client
+                size = rng.choices(*sizes)[0]
+                framing.send_framed(sock, f"PUT load{n}-{puts % 20}".encode())
+                with open(sources[size], "rb") as f:
+                    framing.send_stream(sock, f, size)
+                reply = framing.recv_framed(sock)
+                ok = reply is not None and reply.startswith(b"Upload successful")
+                moved += size if ok else 0
+                puts += 1
+            if not ok: # the connection is gone or out of step, this client is done
+                errors += 1
+                break
+            ops[kind].append(time.perf_counter() - start)
+    return {"ops": ops, "bytes": moved, "errors": errors}
+
+def run_clients(count, port, duration, names, mix, sizes, sources): # forks the clients, returns their tallies
+    deadline = time.monotonic() + duration
+    pipes = []
+    for n in range(count):
+        r, w = os.pipe()
+        if os.fork() == 0:
+            os.close(r)
+            try:
+                result = client(n, port, deadline, names, mix, sizes, sources)
+            except OSError as e:
+                result = {"ops": {}, "bytes": 0, "errors": 1, "failure": str(e)}
+            with os.fdopen(w, "w") as out:
+                json.dump(result, out)
+            os._exit(0)
+        os.close(w)
+        pipes.append(r)
+    results = []
+    for r in pipes: # each child writes only once it is done, so reading them in turn can't deadlock
+        with os.fdopen(r) as f:
+            results.append(json.load(f))
+    for n in range(count):
+        os.wait()
+    return results
+
+def summarize(results, elapsed):
+    latencies = {}
+    for result in results:
+        for kind, values in result["ops"].items():
+            latencies.setdefault(kind, []).extend(values)
+    ops = sum(len(values) for values in latencies.values())
+    moved = sum(result["bytes"] for result in results)
+    summary = {"ops": ops, "ops_per_s": ops / elapsed, "mb_per_s": moved / elapsed / (1 << 20),
+               "errors": sum(result["errors"] for result in results), "latency_ms": {}}
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        summary["latency_ms"][kind] = {"count": len(values)}
+        for q in PERCENTILES:
+            value = percentile(values, q)
+            summary["latency_ms"][kind][f"p{q * 100:g}"] = None if value is None else value * 1000
+    return summary
+
+def main():
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage']:
+        params.usage()
+    mode, port = paramMap['server'], int(paramMap['port'])
+    clients, duration = int(paramMap['clients']), float(paramMap['duration'])
+    mix = parse_weights(paramMap['mix'], lambda kind: kind.upper())
+    sizes = parse_weights(paramMap['sizes'], parse_size)
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        serverDir, sourceDir = os.path.join(tmp, "server"), os.path.join(tmp, "client")
+        os.makedirs(os.path.join(serverDir, "server-files"))
+        os.makedirs(sourceDir)
+        sources = {} # size -> a local file of that size to PUT from
+        for size in sizes[0]:
+            sources[size] = os.path.join(sourceDir, str(size))
+            with open(sources[size], "wb") as f:
+                f.write(os.urandom(size))
+        names = [f"f{i:05d}" for i in range(int(paramMap['files']))]
+        for name in names:
+            size = rng.choices(*sizes)[0]
+            with open(sources[size], "rb") as src, open(os.path.join(serverDir, "server-files", name), "wb") as dst:
+                dst.write(src.read())
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([LIB, os.environ.get("PYTHONPATH", "")]))
+        server = subprocess.Popen(server_command(mode, port, paramMap['workers']), cwd=serverDir, env=env,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            wait_for_server(port)
+            start = time.perf_counter()
+            results = run_clients(clients, port, duration, names, mix, sizes, sources)
+            elapsed = time.perf_counter() - start
+        finally:
+            server.send_signal(signal.SIGTERM) # a prefork supervisor stops and reaps its workers first
+            pid, status, usage = os.wait4(server.pid, 0) # usage includes workers the server reaped
+            server.returncode = status
+
+    summary = summarize(results, elapsed)
+    summary["server_cpu_s"] = usage.ru_utime + usage.ru_stime
+    summary["server_peak_rss_mb"] = usage.ru_maxrss / 1024 # ru_maxrss is in KiB on Linux
+    failures = [result["failure"] for result in results if "failure" in result]
+    record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "server": mode, "clients": clients,
+              "duration": duration, "mix": paramMap['mix'], "sizes": paramMap['sizes'],
+              "files": len(names), "workers": int(paramMap['workers']) if mode == "prefork" else 1,
+              "cpus": os.cpu_count(), **summary}
+
+    print(f"{mode}: {clients} clients for {elapsed:.1f}s, {summary['ops']} ops, {summary['errors']} errors")
+    print(f"  {summary['ops_per_s']:10.1f} ops/s  {summary['mb_per_s']:8.1f} MB/s")
+    for kind, stats in summary["latency_ms"].items():
+        cells = "  ".join(f"{key} {value:8.2f}ms" for key, value in stats.items() if key != "count" and value is not None)
+        print(f"  {kind:>5} x{stats['count']:<7} {cells}")
+    print(f"  server cpu {summary['server_cpu_s']:.2f}s  peak RSS {summary['server_peak_rss_mb']:.1f} MB")
+    for failure in failures:
+        print(f"  client failed: {failure}")
+    with open(paramMap['output'], "a") as out:
+        out.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+
+# Compares mmap against the read/send, sendfile and buffered-write paths of
+# framing.send_stream and recv_stream on loopback. The side being measured
+# runs in a forked child so os.wait4 can report its own cpu time and peak RSS.
+
+import os, socket, sys, tempfile, time
+sys.path.append("../lib")       # for params
+import params
+import framing
+
+switchesVarDefaults = (
+    (('-m', '--megabytes'), 'megabytes', 1024),
+    (('-r', '--rounds'), 'rounds', 3),
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+megabytes, rounds = int(paramMap['megabytes']), int(paramMap['rounds'])
+
+def drain(sock): # read and discard everything until the sender closes
+    buf = bytearray(1 << 20)
+    while sock.recv_into(buf):
+        pass
+
+def get_side(sock, path, size, mode): # the server end of a GET
+    with open(path, "rb") as f:
+        framing.send_stream(sock, f, size, use_sendfile=(mode == "sendfile"), use_mmap=(mode == "mmap"))
+    sock.shutdown(socket.SHUT_WR)
+    sock.recv(1)
+
+def put_side(sock, path, size, mode): # the server end of a PUT
+    with open(path, "w+b") as f:
+        if framing.recv_stream(sock, f, use_mmap=(mode == "mmap")) != size:
+            os._exit(1)
+        f.flush()
+        os.fsync(f.fileno())
+
+def run(measured, other, path, size, mode): # returns (wall seconds, child cpu seconds, child peak RSS in MB)
+    a, b = socket.socketpair()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0: # the measured side
+        a.close()
+        measured(b, path, size, mode)
+        os._exit(0)
+    b.close()
+    other(a)
+    a.close()
+    pid, status, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    assert status == 0
+    return wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024 # ru_maxrss is in KiB on Linux
+
+with tempfile.TemporaryDirectory(dir=".") as tmp:
+    source, dest = os.path.join(tmp, "source"), os.path.join(tmp, "dest")
+    block = os.urandom(1 << 20)
+    with open(source, "wb") as f:
+        for i in range(megabytes):
+            f.write(block)
+    size = megabytes << 20
+    gigabytes = size / (1 << 30)
+    def send_source(sock): # client end of a PUT: read/send, so the client costs the same for every mode
+        with open(source, "rb") as f:
+            framing.send_stream(sock, f, size, use_sendfile=False)
+    def report(label, results):
+        wall, cpu, rss = min(results)
+        print(f"{label:>14}: {megabytes / wall:8.1f} MB/s  {cpu / gigabytes:6.3f} cpu-s/GB  peak RSS {rss:6.1f} MB")
+    for mode in ("read/send", "sendfile", "mmap"):
+        if mode == "sendfile" and not hasattr(os, "sendfile"):
+            continue
+        report("GET " + mode, [run(get_side, drain, source, size, mode) for i in range(rounds)])
+    for mode in ("write", "mmap"):
+        report("PUT " + mode, [run(put_side, send_source, dest, size, mode) for i in range(rounds)])
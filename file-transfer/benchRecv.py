@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+
+# Microbenchmark for the receive side of a streamed transfer.
+# Runs the old recv()/extend()/bytes() receive loop and framing.recv_stream
+# over a socketpair and reports, per MB received: user-space bytes copied,
+# buffer objects the receive loop creates, peak traced memory and time.
+# Copies and buffers are counted by hand from what each loop does, not
+# measured; tracemalloc's peak is the measured memory figure.
+
+import os, socket, sys, threading, time, tracemalloc
+sys.path.append("../lib")       # for params
+import params
+import framing
+
+switchesVarDefaults = (
+    (('-m', '--megabytes'), 'megabytes', 64),
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+class Counts: # tallies kept by the instrumented socket and file
+    def __init__(self):
+        self.copied = self.buffers = 0
+
+class CountingSock: # counts what each receive call costs in user space
+    def __init__(self, sock, counts):
+        self.sock, self.counts = sock, counts
+    def recv(self, n): # a fresh bytes object holding a copy of the data
+        data = self.sock.recv(n)
+        self.counts.buffers += 1
+        self.counts.copied += len(data)
+        return data
+    def recv_into(self, view): # copy into an existing buffer, no new one
+        n = self.sock.recv_into(view)
+        self.counts.copied += n
+        return n
+
+class NullFile: # stands in for the destination file
+    def write(self, data):
+        return len(data)
+
+def legacy_recv_all(sock, n, counts): # the receive loop framing.recv_all replaced
+    data = bytearray()
+    counts.buffers += 1
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet:
+            return None
+        data.extend(packet)
+        counts.copied += len(packet) # extend copies the packet into the bytearray
+    counts.buffers += 1
+    counts.copied += n            # bytes(data) copies the whole message again
+    return bytes(data)
+
+def legacy_recv_stream(sock, f, counts):
+    total = framing.STREAM_HEADER.unpack(legacy_recv_all(sock, 8, counts))[0]
+    received = 0
+    while True:
+        length = framing.FRAME_HEADER.unpack(legacy_recv_all(sock, 4, counts))[0]
+        if length == 0:
+            break
+        f.write(legacy_recv_all(sock, length, counts))
+        received += length
+    return received if received == total else None
+
+def new_recv_stream(sock, f, counts):
+    counts.buffers += 2 # recv_stream's header and chunk buffers, once per stream
+    return framing.recv_stream(sock, f)
+
+def sender(sock, size):
+    block = os.urandom(framing.CHUNK_SIZE)
+    sock.sendall(framing.stream_header(size))
+    for i in range(size // len(block)):
+        sock.sendall(framing.chunk_header(len(block)) + block)
+    sock.sendall(framing.END_OF_STREAM)
+    sock.close()
+
+def run(label, receive, size):
+    a, b = socket.socketpair()
+    counts = Counts()
+    t = threading.Thread(target=sender, args=(a, size))
+    t.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    received = receive(CountingSock(b, counts), NullFile(), counts)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    t.join()
+    b.close()
+    mb = size / (1 << 20)
+    assert received == size
+    print(f"{label:>12}: {counts.copied / mb / (1 << 20):5.2f} MB copied/MB  "
+          f"{counts.buffers / mb:8.2f} buffers/MB  peak {peak / 1024:8.0f} KiB  {mb / elapsed:8.1f} MB/s")
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+size = int(paramMap['megabytes']) * framing.CHUNK_SIZE
+
+run("recv/extend", legacy_recv_stream, size)
+run("recv_into", new_recv_stream, size)
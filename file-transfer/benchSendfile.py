@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+
+# Compares the sendfile and read/send GET paths of framing.send_stream on loopback
+
+import os, socket, sys, tempfile, time
+sys.path.append("../lib")       # for params
+import params
+import framing
+
+switchesVarDefaults = (
+    (('-m', '--megabytes'), 'megabytes', 512),
+    (('-r', '--rounds'), 'rounds', 3),
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+paramMap = params.parseParams(switchesVarDefaults)
+if paramMap['usage']:
+    params.usage()
+megabytes, rounds = int(paramMap['megabytes']), int(paramMap['rounds'])
+
+def drain(sock): # child: read and discard everything until the sender closes
+    buf = bytearray(1 << 20)
+    while sock.recv_into(buf):
+        pass
+    os._exit(0)
+
+def run(path, size, use_sendfile): # returns (wall seconds, sender cpu seconds)
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.bind(("127.0.0.1", 0))
+    lsock.listen(1)
+    if os.fork() == 0: # receiver runs in its own process so its cpu isn't counted
+        addr = lsock.getsockname()
+        lsock.close()
+        drain(socket.create_connection(addr))
+    conn, addr = lsock.accept()
+    lsock.close()
+    with open(path, "rb") as f:
+        wallStart, cpuStart = time.perf_counter(), time.process_time()
+        framing.send_stream(conn, f, size, use_sendfile)
+        conn.shutdown(socket.SHUT_WR)
+        conn.recv(1)             # wait for the receiver to see everything
+        wall, cpu = time.perf_counter() - wallStart, time.process_time() - cpuStart
+    conn.close()
+    os.wait()
+    return wall, cpu
+
+with tempfile.NamedTemporaryFile() as tmp:
+    block = os.urandom(1 << 20)
+    for i in range(megabytes):
+        tmp.write(block)
+    tmp.flush()
+    size = megabytes << 20
+    gigabytes = size / (1 << 30)
+    for label, use_sendfile in (("read/send", False), ("sendfile", True)):
+        if use_sendfile and not hasattr(os, "sendfile"):
+            print(f"{label:>10}: not available on this platform")
+            continue
+        best = min(run(tmp.name, size, use_sendfile) for i in range(rounds))
+        wall, cpu = best
+        print(f"{label:>10}: {megabytes / wall:8.1f} MB/s  {cpu / gigabytes:6.3f} cpu-s/GB")
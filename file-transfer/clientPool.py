@@ -0,0 +1,180 @@
+# Reusable client connections for programs that make many transfers.
+#
+# A ConnectionPool keeps connections to one or more servers open between
+# requests, so a job pays TCP setup (and the CODECS exchange) once per
+# connection rather than once per file. Each server gets at most max_per_host
+# connections; a caller that finds them all busy waits for one to come back.
+# Idle connections are kept newest first, closed after idle_timeout, and
+# checked before reuse with a non-blocking MSG_PEEK: a server that has closed
+# shows up as end of file, and stray bytes mean the connection is out of step.
+# Either way it is replaced by a fresh one. A request that fails on a
+# connection is retried on a new one (GETs resume from dest.part, PUTs replace
+# the whole file), and a server that refuses connections is skipped for
+# DOWN_SECONDS when there are others to try.
+#
+#   pool = ConnectionPool(["localhost:50001"])
+#   pool.get_to_file("a.txt", "/tmp/a.txt"); pool.put_from_file("b.txt"); pool.list()
+
+import socket
+import threading
+import time
+from collections import deque
+import framedThreadClient as client
+
+MAX_PER_HOST = 4        # connections open to one server, busy or idle
+IDLE_TIMEOUT = 60.0     # seconds an unused connection is kept
+CONNECT_TIMEOUT = 5.0
+RETRIES = 1             # extra attempts on a fresh connection after a connection failure
+DOWN_SECONDS = 2.0      # how long a server that refused us is tried last
+KEEPALIVE_IDLE = 30     # seconds of silence before TCP keepalive probes; dead peers show up as errors
+
+class Connection: # one pooled socket and what was negotiated on it
+    def __init__(self, host, sock, codec):
+        self.host, self.sock, self.codec = host, sock, codec
+        self.idle_since = time.monotonic()
+
+    def healthy(self): # no bytes and no end of file waiting: the server still expects a request
+        try:
+            self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False # b"" is end of file; anything else is a reply nobody asked for
+
+    def close(self):
+        self.sock.close()
+
+class Host: # one server's connections
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1) if isinstance(address, str) else address
+        self.address = (host, int(port))
+        self.idle = deque()     # Connections, most recently used last
+        self.open = 0           # idle + checked out
+        self.down_until = 0.0
+
+class ConnectionPool:
+    def __init__(self, servers, max_per_host=MAX_PER_HOST, idle_timeout=IDLE_TIMEOUT, retries=RETRIES,
+                 connect_timeout=CONNECT_TIMEOUT):
+        self.hosts = [Host(server) for server in servers]
+        self.max_per_host, self.idle_timeout = max_per_host, idle_timeout
+        self.retries, self.connect_timeout = retries, connect_timeout
+        self.cond = threading.Condition()
+        self.stats = {"connects": 0, "reuses": 0, "stale": 0, "retries": 0}
+
+    def acquire(self): # a Connection for this thread's exclusive use; hand it back with release()
+        with self.cond:
+            while True:
+                host, conn = self._pick()
+                if conn is not None:
+                    self.stats["reuses"] += 1
+                    return conn
+                if host is not None:
+                    host.open += 1 # reserve the slot, then connect outside the lock
+                    break
+                self.cond.wait()
+        try:
+            return self._connect(host)
+        except OSError:
+            with self.cond:
+                host.open -= 1
+                host.down_until = time.monotonic() + DOWN_SECONDS
+                self.cond.notify()
+            raise
+
+    def release(self, conn, broken=False): # broken: its state is unknown, close it rather than reuse it
+        host = conn.host
+        with self.cond:
+            if broken:
+                host.open -= 1
+            else:
+                conn.idle_since = time.monotonic()
+                host.idle.append(conn)
+            self.cond.notify()
+        if broken:
+            conn.close()
+
+    def close(self): # closes the idle connections; ones checked out close when released broken or on exit
+        with self.cond:
+            for host in self.hosts:
+                while host.idle:
+                    host.idle.pop().close()
+                    host.open -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _pick(self): # (host, idle connection) to reuse, or (host, None) to connect to, or (None, None) to wait
+        now = time.monotonic()
+        spare = None
+        for host in sorted(self.hosts, key=lambda host: (host.down_until > now, host.open - len(host.idle))):
+            while host.idle:
+                conn = host.idle.pop()
+                if now - conn.idle_since < self.idle_timeout and conn.healthy():
+                    return host, conn
+                self.stats["stale"] += 1
+                conn.close()
+                host.open -= 1
+            if spare is None and host.open < self.max_per_host:
+                spare = host
+        return spare, None
+
+    def _connect(self, host):
+        sock = socket.create_connection(host.address, timeout=self.connect_timeout)
+        try:
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"): # Linux; elsewhere the system default applies
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            codec = client.negotiate(sock)
+        except OSError:
+            sock.close()
+            raise
+        with self.cond:
+            self.stats["connects"] += 1
+        return Connection(host, sock, codec)
+
+    def run(self, job): # job(conn) on a pooled connection, retried on a fresh one if the connection fails
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self.acquire()
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                continue
+            try:
+                result = job(conn)
+            except ConnectionError: # reset, closed or out of step: worth another try on a new connection
+                self.release(conn, broken=True)
+                if attempt == self.retries:
+                    raise
+                with self.cond:
+                    self.stats["retries"] += 1
+                continue
+            except BaseException: # e.g. a local file error, maybe mid-stream: don't reuse the connection
+                self.release(conn, broken=True)
+                raise
+            self.release(conn)
+            return result
+
+    def get_to_file(self, name, dest=None, local_digest=None): # returns the client's message, e.g. "File downloaded." or an ERROR
+        def job(conn):
+            result = client.get_file(conn.sock, name, dest or name, local_digest)
+            if result is None:
+                raise ConnectionError("download interrupted")
+            return result
+        return self.run(job)
+
+    def put_from_file(self, path, name=None): # stored as name, by default the file's base name; returns the server's reply
+        return self.run(lambda conn: client.put_file(conn.sock, path, conn.codec, name))
+
+    def list(self): # names of the files on a server
+        def job(conn):
+            client.send_request(conn.sock, "LIST")
+            reply = client.recv_reply(conn.sock)
+            return reply.decode().split("\n") if reply else []
+        return self.run(job)
@@ -0,0 +1,221 @@
+# Content-defined chunking and delta uploads (DPUT).
+#
+# The client cuts a file into chunks wherever a rolling gear hash hits a
+# boundary pattern, so an edit only changes the chunks around it. It sends
+# the list of chunk digests; the server answers with the chunks it can't find
+# in files it already stores, and only those cross the wire.
+#
+# The server's chunk index maps digest -> (file, offset, length). It is built
+# from the manifest saved for every file stored by DPUT, and each hit is
+# re-hashed before use, so a file replaced by a plain PUT can't poison it.
+# Prefork workers each keep their own index: a worker only learns about
+# manifests written by the others when it is restarted.
+
+import os
+import struct
+import hashlib
+import threading
+try:
+    import numpy                # optional, vectorises the chunk boundary scan
+except ImportError:
+    numpy = None
+from framing import send_framed, recv_framed
+import fileStore
+
+SERVER_MANIFEST_DIR = "server-manifests"
+
+MIN_CHUNK = 16 * 1024           # no boundary is looked for before this many bytes
+BOUNDARY_BELOW = 1 << 48        # 16 high bits must be zero: about one boundary per 64 KiB
+WINDOW = 64                     # older bytes have been shifted out of the 64-bit hash
+MAX_CHUNK = 256 * 1024          # forced boundary
+READ_SIZE = 1024 * 1024
+M64 = (1 << 64) - 1
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), "big") for i in range(256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+MANIFEST_ENTRY = struct.Struct("!32sI") # digest, chunk length
+INDEX = struct.Struct("!I")             # chunk number in a missing-chunk list
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+def _cut_points(buf): # positions in buf where the gear hash of the WINDOW bytes ending there hits the pattern
+    if numpy is None:
+        return None
+    h = GEAR_ARRAY.take(numpy.frombuffer(buf, numpy.uint8))
+    width = 1
+    while width < WINDOW: # h[i] += h[i - width] << width, doubling the bytes summed (wraps mod 2**64 like M64)
+        h[width:] += h[:-width] << numpy.uint64(width)
+        width *= 2
+    return numpy.flatnonzero(h < BOUNDARY_BELOW) # exact from WINDOW - 1 on, all _boundary asks
+
+def _boundary(buf, start, cuts=None): # length of the next chunk, the one starting at buf[start]
+    n = min(len(buf) - start, MAX_CHUNK)
+    if n <= MIN_CHUNK:
+        return n
+    stop = start + n
+    scan_to = stop if cuts is None else min(stop, start + MIN_CHUNK + WINDOW - 1)
+    h = 0
+    gear = GEAR
+    for end, b in enumerate(buf[start + MIN_CHUNK:scan_to], start + MIN_CHUNK + 1): # end: just past b
+        h = ((h << 1) + gear[b]) & M64
+        if h < BOUNDARY_BELOW:
+            return end - start
+    if scan_to < stop: # the hash now covers a full window, so the precomputed cut points apply
+        j = cuts.searchsorted(scan_to)
+        if j < len(cuts) and cuts[j] < stop:
+            return int(cuts[j]) + 1 - start
+    return n
+
+def cdc_chunks(f): # yields (offset, length, digest) for each content-defined chunk of f
+    buf = b""
+    pos = 0                     # where the next chunk starts in buf
+    offset = 0                  # ... and in the file
+    while True:
+        data = f.read(READ_SIZE)
+        buf = buf[pos:] + data  # the undecided tail is copied once per read, not once per chunk
+        pos = 0
+        view = memoryview(buf)
+        cuts = _cut_points(buf)
+        while len(buf) - pos >= MAX_CHUNK or (not data and pos < len(buf)): # decide only once a full window is known
+            cut = _boundary(view, pos, cuts)
+            yield offset, cut, digest(view[pos:pos + cut])
+            offset += cut
+            pos += cut
+        if not data:
+            return
+
+def encode_manifest(chunks): # chunks: (digest, length) pairs
+    return b"".join(MANIFEST_ENTRY.pack(d, n) for d, n in chunks)
+
+def decode_manifest(data):
+    if len(data) % MANIFEST_ENTRY.size:
+        return None
+    return list(MANIFEST_ENTRY.iter_unpack(data))
+
+class ChunkIndex: # digest -> (file name, offset, length) over files stored by DPUT
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.where = {}         # digest -> (name, offset, length)
+        self.files = {}         # name -> digests recorded for it
+
+    def load(self): # rebuild from the manifests left by earlier runs
+        os.makedirs(SERVER_MANIFEST_DIR, exist_ok=True)
+        for top, dirs, files in os.walk(SERVER_MANIFEST_DIR): # files in subdirectories have theirs in subdirectories
+            for file in files:
+                path = os.path.join(top, file)
+                name = os.path.relpath(path, SERVER_MANIFEST_DIR).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    chunks = decode_manifest(f.read())
+                if chunks is not None and os.path.isfile(fileStore.file_path(name)):
+                    self._add(name, chunks)
+
+    def _add(self, name, chunks):
+        offset = 0
+        for d, n in chunks:
+            self.where[d] = (name, offset, n)
+            offset += n
+        self.files[name] = [d for d, n in chunks]
+
+    def _drop(self, name):
+        for d in self.files.pop(name, ()):
+            if self.where.get(d, (None,))[0] == name:
+                del self.where[d]
+
+    def lookup(self, d):
+        with self.lock:
+            return self.where.get(d)
+
+    def record(self, name, manifest): # name now holds exactly these chunks
+        path = os.path.join(SERVER_MANIFEST_DIR, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(manifest)
+        with self.lock:
+            self._drop(name)
+            self._add(name, decode_manifest(manifest))
+
+    def forget(self, name): # name was replaced by something we have no manifest for
+        with self.lock:
+            self._drop(name)
+        try:
+            os.unlink(os.path.join(SERVER_MANIFEST_DIR, name))
+        except FileNotFoundError:
+            pass
+
+index = ChunkIndex()
+
+def init():
+    index.load()
+
+def _copy_known(d, n, out, offset): # copy a chunk we already store into out, False if it went stale
+    hit = index.lookup(d)
+    if hit is None or hit[2] != n:
+        return False
+    name, src_offset, length = hit
+    try:
+        fd = os.open(fileStore.file_path(name), os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        data = os.pread(fd, length, src_offset)
+    finally:
+        os.close(fd)
+    if len(data) != n or digest(data) != d: # file changed under the index entry
+        return False
+    os.pwrite(out.fileno(), data, offset)
+    return True
+
+def serve_delta_put(sock, name): # DPUT <file>: returns the reply, or None if the connection broke
+    manifest = recv_framed(sock)
+    if manifest is None:
+        return None
+    manifest = bytes(manifest)
+    chunks = decode_manifest(manifest)
+    if chunks is None:
+        return b"ERROR: Bad manifest"
+    try:
+        out = fileStore.open_upload(name)
+    except OSError as e: # busy, or the name clashes with a directory
+        return fileStore.upload_refusal(e)
+    with out: # readable too, repeats are copied from it
+        out.truncate(sum(n for d, n in chunks))
+        offsets, missing, same = [], [], {} # same: digest -> every chunk number carrying it
+        offset = 0
+        for i, (d, n) in enumerate(chunks):
+            offsets.append(offset)
+            if d in same: # repeated inside this file, filled in from its first copy below
+                same[d].append(i)
+            else:
+                same[d] = [i]
+                if not _copy_known(d, n, out, offset):
+                    missing.append(i)
+            offset += n
+        send_framed(sock, f"OK {len(missing)}".encode())
+        send_framed(sock, b"".join(INDEX.pack(i) for i in missing))
+        good = True
+        for i in missing: # the client sends exactly these chunks, in this order
+            data = recv_framed(sock)
+            if data is None:
+                return None
+            d, n = chunks[i]
+            if len(data) != n or digest(data) != d:
+                good = False
+                continue
+            for j in same[d]:
+                os.pwrite(out.fileno(), data, offsets[j])
+        if not good:
+            return b"ERROR: Chunk digest mismatch"
+        received = set(missing)
+        for d, where in same.items(): # repeats of chunks that were copied from the store
+            if len(where) > 1 and where[0] not in received:
+                data = os.pread(out.fileno(), chunks[where[0]][1], offsets[where[0]])
+                for j in where[1:]:
+                    os.pwrite(out.fileno(), data, offsets[j])
+        try:
+            fileStore.commit_upload(out, name)
+        except OSError as e:
+            return fileStore.upload_refusal(e)
+    index.record(name, manifest)
+    sent = sum(chunks[i][1] for i in missing)
+    return f"Upload successful ({sent} of {offset} bytes sent)".encode()
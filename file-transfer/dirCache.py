@@ -0,0 +1,144 @@
+# Cached listing of SERVER_FILES_DIR for LIST and LISTX.
+#
+# One os.scandir pass fills a sorted name list plus size and mtime for every
+# file. The scan is reused until the directory's own mtime moves (something
+# was created, removed or renamed in it); the servers' own uploads update
+# their single entry through fileStore's commit hook instead of forcing a
+# rescan, but only when the directory's mtime from just before the rename
+# is the one the cache matches: anything else means a stranger (a file
+# copied in by hand, another prefork worker) changed it too. A scan taken
+# within RACY_WINDOW of the directory's mtime isn't trusted, since coarse
+# filesystem timestamps can hide a change made in the same tick; for the
+# same reason a carried-forward mtime is checked with one rescan once
+# RACY_WINDOW has passed.
+
+import os
+import time
+import struct
+import bisect
+import fnmatch
+import threading
+import fileStore
+
+RACY_WINDOW = 1.0               # seconds; see above
+DEFAULT_PAGE = 1000             # LISTX entries per reply unless limit= says otherwise
+MAX_PAGE = 10000
+
+LISTX_HEADER = struct.Struct("!IB")     # entry count, more-pages flag
+LISTX_ENTRY = struct.Struct("!HQq")     # name length, size, mtime in ns; the name follows
+
+class DirCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.names = []         # sorted
+        self.meta = {}          # name -> (size, mtime_ns)
+        self.dir_mtime = None   # directory mtime the cache matches, None when a rescan is due
+        self.verify_at = None   # time_ns after which a carried-forward dir_mtime gets its rescan
+
+    def _scan(self):
+        started = time.time_ns()
+        dir_mtime = os.stat(self.path).st_mtime_ns
+        meta = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat() # scandir already has the type, stat is the only syscall
+                    meta[entry.name] = (st.st_size, st.st_mtime_ns)
+        self.meta, self.names = meta, sorted(meta)
+        racy = started - dir_mtime < RACY_WINDOW * 1e9
+        self.dir_mtime = None if racy else dir_mtime
+        self.verify_at = None
+
+    def _fresh(self): # caller holds the lock
+        if (self.dir_mtime is None or os.stat(self.path).st_mtime_ns != self.dir_mtime
+                or self.verify_at is not None and time.time_ns() >= self.verify_at):
+            self._scan()
+
+    def updated(self, name, dir_mtime_ns): # one of our own uploads just landed under name
+        # dir_mtime_ns: the directory's mtime just before our rename
+        if "/" in name: # in a subdirectory: LIST and LISTX show only the top level
+            return
+        with self.lock:
+            if self.dir_mtime is None:
+                return # a rescan is due anyway
+            if dir_mtime_ns != self.dir_mtime: # changed by someone else since the scan
+                self.dir_mtime = None
+                return
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                self.dir_mtime = None
+                return
+            if name not in self.meta:
+                bisect.insort(self.names, name)
+            self.meta[name] = (st.st_size, st.st_mtime_ns)
+            self.dir_mtime = os.stat(self.path).st_mtime_ns # our rename moved it, not a stranger
+            if self.verify_at is None: # but one may share its tick, so rescan once that can't be
+                self.verify_at = time.time_ns() + int(RACY_WINDOW * 1e9)
+
+    def names_snapshot(self): # a copy, updated() may insert into the live list
+        with self.lock:
+            self._fresh()
+            return list(self.names)
+
+    def page(self, after="", limit=DEFAULT_PAGE, pattern=None): # ([(name, size, mtime_ns)], more)
+        with self.lock:
+            self._fresh()
+            names, meta = self.names, self.meta
+            i = bisect.bisect_right(names, after) if after else 0
+            entries = []
+            while i < len(names):
+                name = names[i]
+                i += 1
+                if pattern and not fnmatch.fnmatchcase(name, pattern):
+                    continue
+                if len(entries) == limit:
+                    return entries, True
+                entries.append((name,) + meta[name])
+            return entries, False
+
+cache = DirCache(fileStore.SERVER_FILES_DIR)
+fileStore.commit_hooks.append(cache.updated)
+
+def list_reply(args=()): # LIST: newline-separated names; LIST digests: "<sha256>  <name>" lines, as sha256sum prints them
+    if not args:
+        return "\n".join(cache.names_snapshot()).encode()
+    if list(args) != ["digests"]:
+        return b"ERROR: Bad LIST option"
+    lines = []
+    for name in cache.names_snapshot(): # a file without a sidecar yet is hashed once, here
+        hexdigest = fileStore.file_digest(name)
+        if hexdigest is not None: # removed since the snapshot
+            lines.append(f"{hexdigest}  {name}")
+    return "\n".join(lines).encode()
+
+def listx_reply(args): # LISTX [limit=<n>] [after=<name>] [glob=<pattern>]
+    options = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in ("limit", "after", "glob"):
+            return b"ERROR: Bad LISTX option " + arg.encode()
+        options[key] = value
+    limit = options.get("limit", str(DEFAULT_PAGE))
+    if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE:
+        return b"ERROR: Bad limit"
+    entries, more = cache.page(options.get("after", ""), int(limit), options.get("glob"))
+    out = [b"OK", LISTX_HEADER.pack(len(entries), more)]
+    for name, size, mtime_ns in entries:
+        encoded = name.encode(errors="surrogateescape")
+        out.append(LISTX_ENTRY.pack(len(encoded), size, mtime_ns))
+        out.append(encoded)
+    return b"".join(out)
+
+def parse_listx(reply): # client side: ([(name, size, mtime_ns)], more) from an OK reply
+    view = memoryview(reply)[2:]
+    count, more = LISTX_HEADER.unpack_from(view)
+    pos = LISTX_HEADER.size
+    entries = []
+    for i in range(count):
+        length, size, mtime_ns = LISTX_ENTRY.unpack_from(view, pos)
+        pos += LISTX_ENTRY.size
+        entries.append((bytes(view[pos:pos + length]).decode(errors="surrogateescape"), size, mtime_ns))
+        pos += length
+    return entries, bool(more)
@@ -0,0 +1,119 @@
+# Worker threads for the blocking file calls of an event loop server.
+#
+# The loop never touches the disk itself: opens, reads, writes, fsyncs and
+# directory scans are submitted here, run on a fixed set of threads, and each
+# job's result comes back to the loop through a callback run by
+# run_completions() once the wakeup socket turns readable. Jobs go to one of
+# two thread groups. Quick ones (opens, listings, small files) never queue
+# behind bulk ones (chunks of large transfers, fsyncs), so a slow disk
+# streaming a big file doesn't hold up a small request's open. The threads
+# are bounded; callers bound the queue by keeping only a few jobs in flight
+# per transfer (see framedSelectServer's read-ahead and write-behind).
+
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+import metrics
+
+QUICK_THREADS = 2
+BULK_THREADS = 4
+
+queue_depth = metrics.Gauge("ft_disk_queue_depth", "Disk jobs waiting for a thread", ("pool",))
+queue_seconds = metrics.Histogram("ft_disk_queue_seconds", "Time disk jobs waited for a thread", ("pool",))
+job_seconds = metrics.Histogram("ft_disk_job_seconds", "Time disk jobs ran", ("pool",))
+
+def timed(name, queued, fn, *args): # fn(*args) as a job of pool name submitted at queued, counted in the metrics
+    started = time.perf_counter()
+    queue_depth.dec(1, name)
+    queue_seconds.observe(started - queued, name)
+    try:
+        return fn(*args)
+    finally:
+        job_seconds.observe(time.perf_counter() - started, name)
+
+class DiskPool:
+    def __init__(self, quick_threads=QUICK_THREADS, bulk_threads=BULK_THREADS):
+        self.queues = {"quick": queue.SimpleQueue(), "bulk": queue.SimpleQueue()}
+        self.completions = deque()      # (done, result, exception) for the loop
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.lock = threading.Lock()
+        self.signalled = False          # a wakeup byte is on its way and not yet drained
+        for name, count in (("quick", quick_threads), ("bulk", bulk_threads)):
+            for i in range(count):
+                threading.Thread(target=self._work, args=(name,), daemon=True).start()
+
+    def fileno(self): # readable when run_completions() has work
+        return self.rsock.fileno()
+
+    def submit(self, fn, *args, done=None, bulk=False, then=None): # done(result, exception) runs on the loop
+        name = "bulk" if bulk else "quick"
+        queue_depth.inc(1, name)
+        self.queues[name].put((fn, args, done, then, time.perf_counter()))
+
+    def serial(self, bulk=True): # a queue whose jobs run one at a time, in order
+        return Serial(self, bulk)
+
+    def depth(self): # jobs waiting, by pool
+        return {name: queue_depth.get(name) for name in self.queues}
+
+    def _work(self, name):
+        jobs = self.queues[name]
+        while True:
+            fn, args, done, then, queued = jobs.get()
+            result = exception = None
+            try:
+                result = timed(name, queued, fn, *args)
+            except Exception as e: # handed to the loop, which knows which client it belongs to
+                exception = e
+            if done is not None:
+                self.completions.append((done, result, exception))
+                with self.lock:
+                    wake, self.signalled = not self.signalled, True
+                if wake:
+                    self.wsock.send(b"x")
+            if then is not None:
+                then()
+
+    def run_completions(self): # on the loop: run the callbacks of finished jobs
+        with self.lock:
+            self.signalled = False
+            try:
+                while self.rsock.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+        completions = self.completions
+        while completions:
+            done, result, exception = completions.popleft()
+            try:
+                done(result, exception)
+            except Exception: # one client's callback must not strand the others' results
+                traceback.print_exc(file=sys.stdout)
+
+class Serial: # jobs that must not overlap or reorder, e.g. the writes and commit of one upload
+    def __init__(self, pool, bulk):
+        self.pool, self.bulk = pool, bulk
+        self.jobs = deque()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def submit(self, fn, *args, done=None):
+        with self.lock:
+            self.jobs.append((fn, args, done))
+            if self.running:
+                return
+            self.running = True
+        self._next()
+
+    def _next(self):
+        with self.lock:
+            if not self.jobs:
+                self.running = False
+                return
+            fn, args, done = self.jobs.popleft()
+        self.pool.submit(fn, *args, done=done, bulk=self.bulk, then=self._next)
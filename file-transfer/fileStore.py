@@ -0,0 +1,215 @@
+# Server-side file storage shared by the file transfer servers.
+#
+# Finished files live in SERVER_FILES_DIR. A PUT is written to a partial file
+# in SERVER_PARTIAL_DIR and renamed into place only once the whole stream has
+# arrived, so GET and LIST never see a truncated file and an interrupted
+# upload can be resumed from its last good chunk. A partial file is flock'ed
+# while an upload writes it, so a second PUT of the same name (from another
+# connection or prefork worker) is refused rather than interleaved with the
+# first, and the rename happens before the lock is let go. Names may be paths
+# into subdirectories, created as uploads need them; parse_request already
+# refuses any that could leave the store, and the *_path helpers check again.
+#
+# Each stored file's SHA-256 is kept in a sidecar under SERVER_META_DIR
+# together with the size, mtime and inode it describes. A PUT's digest is
+# computed while its body streams in, so storing it costs no second pass;
+# a file that arrived some other way (DPUT, copied in by hand) is hashed
+# the first time a digest is asked for. A sidecar that no longer matches
+# its file is ignored, so a lost or stale one only costs a rehash.
+
+import os
+import fcntl
+import hashlib
+import threading
+from framing import CHUNK_SIZE, DIGEST, chunk_sums, format_sums, hash_file, safe_path
+
+SERVER_FILES_DIR = "server-files"
+SERVER_PARTIAL_DIR = "server-partial" # beside SERVER_FILES_DIR so the final rename is atomic
+SERVER_META_DIR = "server-meta" # digest sidecars, one per stored file
+HASH_UPLOADS = True # about 1 ns/byte of cpu per PUT; off, a file is hashed when a digest is first asked for
+
+commit_hooks = [] # called with the file name and its directory's mtime_ns from just before each upload's rename
+
+def init():
+    os.makedirs(SERVER_FILES_DIR, exist_ok=True)
+    os.makedirs(SERVER_PARTIAL_DIR, exist_ok=True)
+    os.makedirs(SERVER_META_DIR, exist_ok=True)
+
+def _inside(root, name): # root/name, for a name that can't climb out of root
+    if not safe_path(name):
+        raise ValueError(f"unsafe path {name!r}")
+    return os.path.join(root, name)
+
+def file_path(name):
+    return _inside(SERVER_FILES_DIR, name)
+
+def partial_path(name):
+    return _inside(SERVER_PARTIAL_DIR, name)
+
+def meta_path(name):
+    return _inside(SERVER_META_DIR, name)
+
+def _make_parent(path):
+    parent = os.path.dirname(path)
+    if parent not in (SERVER_FILES_DIR, SERVER_PARTIAL_DIR, SERVER_META_DIR):
+        os.makedirs(parent, exist_ok=True)
+
+class UploadBusy(OSError): # another upload of the same name holds its partial file
+    pass
+
+def _lock_partial(path, create): # the partial file at path, opened and exclusively locked; None if missing
+    while True:
+        try:
+            fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise UploadBusy(f"upload of {path} already in progress")
+        st = os.fstat(fd)
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            current = None
+        if current is not None and (current.st_dev, current.st_ino) == (st.st_dev, st.st_ino):
+            return os.fdopen(fd, "r+b") # readable too, so the body can be received into an mmap
+        os.close(fd) # committed and renamed away between our open and lock: that inode is a stored file now
+        if not create:
+            return None
+
+def upload_refusal(e): # the reply for an upload that open_upload or commit_upload raised e on
+    if isinstance(e, UploadBusy):
+        return b"ERROR: Upload already in progress"
+    if isinstance(e, (IsADirectoryError, NotADirectoryError, FileExistsError)): # "a" vs "a/b" in one tree
+        return b"ERROR: Name clashes with a stored file or directory"
+    return f"ERROR: Cannot store file: {e.strerror or e}".encode()
+
+def identity(st): # what must still match for a sidecar (or a cached copy) to describe the file
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def open_upload(name, offset=0): # locked partial file positioned at offset, None if it can't resume there
+    # raises UploadBusy while another upload of name is open; the lock goes with the file's close
+    path = partial_path(name)
+    if offset == 0:
+        _make_parent(path)
+        f = _lock_partial(path, create=True)
+        f.truncate(0)
+        return f
+    if offset < 0 or offset % CHUNK_SIZE: # resumes only start on chunk boundaries
+        return None
+    f = _lock_partial(path, create=False)
+    if f is None:
+        return None
+    if offset > os.fstat(f.fileno()).st_size:
+        f.close()
+        return None
+    f.truncate(offset) # anything past offset is about to be resent
+    f.seek(offset)
+    return f
+
+def upload_digest(f, offset): # digest to feed an upload's body, None if off; a resumed one first hashes what is on disk
+    return hash_file(f, offset) if HASH_UPLOADS else None
+
+def commit_upload(f, name, digest=None): # the whole stream arrived: make it durable, then move it into place
+    f.flush()
+    os.fsync(f.fileno())
+    st = os.fstat(f.fileno())
+    try:
+        _make_parent(file_path(name))
+        dir_mtime_ns = os.stat(os.path.dirname(file_path(name))).st_mtime_ns # lets dirCache tell our change from others'
+        os.replace(partial_path(name), file_path(name)) # still locked: nobody else can have opened what we rename
+        # the digest was fed exactly the bytes of this inode (see upload_digest), so it may describe the
+        # stored file only if that is still this inode; sidecars of one name are written in commit order
+        if digest is not None and identity(os.stat(file_path(name))) == identity(st):
+            _store_digest(name, st, digest.hexdigest())
+        else:
+            _forget_digest(name)
+    finally:
+        f.close()
+    for hook in commit_hooks:
+        hook(name, dir_mtime_ns)
+
+_digests = {}   # name -> (identity, hex digest): sidecars already read or written by this process
+_digests_lock = threading.Lock()
+
+def _store_digest(name, st, hexdigest): # the sidecar isn't fsynced, losing it only costs a rehash
+    path = meta_path(name)
+    _make_parent(path)
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}" # two writers of one name never share a temp file
+    with open(temp, "w") as out:
+        out.write(f"{DIGEST} {hexdigest} {st.st_size} {st.st_mtime_ns} {st.st_ino}\n")
+    os.replace(temp, path)
+    with _digests_lock:
+        _digests[name] = (identity(st), hexdigest)
+
+def _forget_digest(name):
+    with _digests_lock:
+        _digests.pop(name, None)
+    try:
+        os.unlink(meta_path(name))
+    except FileNotFoundError:
+        pass
+
+def file_digest(name, st=None, compute=True, data=None): # hex digest of a stored file; None if missing, or unknown and not computed
+    # data: the whole file as described by st, already read by the caller, to hash instead of reading it again
+    try:
+        st = st or os.stat(file_path(name))
+    except OSError:
+        return None
+    with _digests_lock:
+        entry = _digests.get(name)
+    if entry is not None and entry[0] == identity(st):
+        return entry[1]
+    try:
+        with open(meta_path(name)) as f:
+            algorithm, hexdigest, *described = f.read().split()
+        if algorithm == DIGEST and tuple(map(int, described)) == identity(st):
+            with _digests_lock:
+                _digests[name] = (identity(st), hexdigest)
+            return hexdigest
+    except (OSError, ValueError):
+        pass
+    if data is not None and len(data) == st.st_size:
+        hexdigest = hashlib.new(DIGEST, data).hexdigest()
+        _store_digest(name, st, hexdigest)
+        return hexdigest
+    if not compute:
+        return None
+    try:
+        with open(file_path(name), "rb") as f:
+            st = os.fstat(f.fileno()) # describe what we hash; a change meanwhile leaves the sidecar stale
+            hexdigest = hash_file(f).hexdigest()
+    except OSError:
+        return None
+    _store_digest(name, st, hexdigest)
+    return hexdigest
+
+def digest_matches(name, tag): # GET-IF-NONE-MATCH: the client's copy ("<hex>" or "sha256=<hex>") is current
+    algorithm, sep, hexdigest = tag.rpartition("=")
+    if sep and algorithm != DIGEST:
+        return False
+    return hexdigest.lower() == file_digest(name)
+
+def get_status(name, st, ranged=False): # GET's OK frame: OK [<file size>] [sha256=<hex> if already known]
+    parts = ["OK", str(st.st_size)] if ranged else ["OK"]
+    hexdigest = file_digest(name, st, compute=False)
+    if hexdigest is not None:
+        parts.append(f"{DIGEST}={hexdigest}")
+    return " ".join(parts).encode()
+
+def _sums_reply(path, count, missing): # "OK <size> <crc32> ..." for path, or missing if it can't be read
+    try:
+        with open(path, "rb") as f:
+            return ("OK " + format_sums(os.fstat(f.fileno()).st_size, chunk_sums(f, count))).encode()
+    except OSError: # not there, or the name runs into a directory or through a file
+        return missing
+
+def resume_reply(name): # RESUME <file>: size and chunk sums of an interrupted upload
+    return _sums_reply(partial_path(name), None, b"ERROR: No partial upload")
+
+def sums_reply(name, count=None): # SUMS <file> [<count>]: size and leading chunk sums of a stored file
+    if count is not None and count < 0:
+        return b"ERROR: Bad count"
+    return _sums_reply(file_path(name), count, b"ERROR: File not found")
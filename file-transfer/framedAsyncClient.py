@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+# asyncio client for the framed LIST/GET/PUT protocol.
+# The coroutines below can be imported; run as a script it performs one
+# command, e.g.  -c "GET a b c"  downloads a, b and c concurrently.
+
+import asyncio, os, re, sys
+sys.path.append("../lib")       # for params
+import params
+from framing import read_frame, write_frame, read_stream, write_stream
+
+switchesVarDefaults = (
+    (('-s', '--server'), 'server', "localhost:50000"),
+    (('-c', '--command'), 'command', "LIST"),
+    (('-j', '--jobs'), 'jobs', 64), # connections open at once
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+async def list_files(reader, writer): # returns the server's listing as a string
+    await write_frame(writer, b"LIST")
+    return (await read_frame(reader)).decode()
+
+async def get_file(reader, writer, name, dest=None): # returns bytes received, or an error string
+    await write_frame(writer, f"GET {name}".encode())
+    status = await read_frame(reader)
+    if status is None:
+        raise ConnectionError("server closed the connection")
+    if status.startswith(b"ERROR"):
+        return status.decode()
+    with open(dest or name, "wb") as f:
+        received = await read_stream(reader, f)
+    if received is None:
+        raise ConnectionError("download interrupted")
+    return received
+
+async def put_file(reader, writer, path, name=None): # returns the server's reply
+    await write_frame(writer, f"PUT {name or os.path.basename(path)}".encode())
+    with open(path, "rb") as f:
+        await write_stream(writer, f, os.fstat(f.fileno()).st_size)
+    reply = await read_frame(reader)
+    if reply is None:
+        raise ConnectionError("server closed the connection")
+    return reply.decode()
+
+async def with_connection(host, port, job, *args): # one connection per job
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await job(reader, writer, *args)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+async def run(host, port, command, jobs):
+    tokens = command.split()
+    cmd, names = tokens[0].upper(), tokens[1:]
+    if cmd == "LIST":
+        print("Files on server:\n", await with_connection(host, port, list_files))
+        return
+    job = {"GET": get_file, "PUT": put_file}.get(cmd)
+    if job is None or not names:
+        print("Unknown or malformed command.")
+        return
+    limit = asyncio.Semaphore(jobs)
+    async def one(name):
+        async with limit:
+            try:
+                print(f"{cmd} {name}: {await with_connection(host, port, job, name)}")
+            except OSError as e:
+                print(f"{cmd} {name}: failed ({e})")
+    await asyncio.gather(*(one(name) for name in names))
+
+def main():
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage']:
+        params.usage()
+    try:
+        host, port = re.split(":", paramMap['server'])
+        port = int(port)
+    except ValueError:
+        print("Can't parse server:port from '%s'" % paramMap['server'])
+        sys.exit(1)
+    asyncio.run(run(host, port, paramMap['command'], int(paramMap['jobs'])))
+
+if __name__ == "__main__":
+    main()
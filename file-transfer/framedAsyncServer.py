@@ -0,0 +1,190 @@
+#! /usr/bin/env python3
+
+# asyncio server for the framed LIST/GET/PUT protocol.
+# serve() can be awaited from another asyncio program to embed the server.
+# The loop does no file I/O of its own: opens, chunk reads and writes,
+# fsyncs, hashing and directory scans run on two small thread pools, split
+# as in diskPool (quick jobs never queue behind bulk ones), so one client's
+# cold file doesn't stall the others. Their queue depth, waits and run times
+# go to the same metrics as diskPool's, served on /metrics with -m.
+
+import asyncio, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append("../lib")       # for params
+import params
+from framing import (read_frame, write_frame, read_stream, write_stream, FramingError, clip_range,
+                     frame, encode_stream, parse_request, CHUNK_SIZE)
+import fileStore
+import dirCache
+import manifest
+import diskPool
+import metrics
+
+switchesVarDefaults = (
+    (('-l', '--listenPort') ,'listenPort', 50001),
+    (('-t', '--threads'), 'threads', diskPool.BULK_THREADS), # disk threads for transfer bodies
+    (('-m', '--metricsPort'), 'metricsPort', 9103), # /metrics (disk queue depth and waits); 0 turns it off
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+quick_disk = bulk_disk = None # executors for blocking file calls, started by serve()
+
+async def on_disk(fn, *args, bulk=False): # fn(*args) on a disk thread; bulk for anything that reads a whole file
+    name = "bulk" if bulk else "quick"
+    diskPool.queue_depth.inc(1, name)
+    job = (bulk_disk if bulk else quick_disk).submit(diskPool.timed, name, time.perf_counter(), fn, *args)
+    job.add_done_callback(lambda job: job.cancelled() and diskPool.queue_depth.dec(1, name)) # never started
+    return await asyncio.wrap_future(job)
+
+def open_get(name, offset=None, length=None, tag=None): # on a disk thread: (file, status, length, body)
+    # file is None when status is the whole reply or the body was small enough to read here
+    if tag is not None and fileStore.digest_matches(name, tag): # GET-IF-NONE-MATCH
+        return None, f"UNCHANGED {fileStore.DIGEST}={fileStore.file_digest(name)}".encode(), 0, None
+    try:
+        f = open(fileStore.file_path(name), "rb")
+    except OSError:
+        return None, b"ERROR: File not found", 0, None
+    st = os.fstat(f.fileno())
+    if offset is None:
+        status, length = fileStore.get_status(name, st), st.st_size
+    else: # GET <file> <offset> <length>
+        byte_range = clip_range(offset, length, st.st_size)
+        if byte_range is None:
+            f.close()
+            return None, b"ERROR: Bad range", 0, None
+        offset, length = byte_range
+        f.seek(offset)
+        status = fileStore.get_status(name, st, ranged=True)
+    if length > CHUNK_SIZE:
+        return f, status, length, None
+    with f:
+        return None, status, length, f.read(length)
+
+def open_put(name, offset): # on a disk thread: (partial file or None, refusal, digest to feed)
+    try:
+        f = fileStore.open_upload(name, offset)
+    except OSError as e: # busy, or the name clashes with a directory
+        return None, fileStore.upload_refusal(e), None
+    if f is None:
+        return None, b"ERROR: Cannot resume at that offset", None
+    return f, None, fileStore.upload_digest(f, offset) # a resumed upload hashes what it already has
+
+async def send_body(writer, f, status, length, body): # an opened GET: status frame, then the stream
+    writer.write(frame(status))
+    if f is None:
+        if body is not None: # the transport buffers small files into large writes
+            writer.write(encode_stream(body))
+        return
+    try:
+        await write_stream(writer, f, length, executor=bulk_disk)
+    finally:
+        f.close()
+
+async def send_many(writer, names): # MGET: per file an OK frame and stream, or an ERROR frame
+    writer.write(frame(f"OK {len(names)}".encode()))
+    for name in names:
+        await send_body(writer, *await on_disk(open_get, name))
+        await writer.drain()
+    await writer.drain()
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
+    print(f"[+] Connection from {addr}")
+    try:
+        while True:
+            data = await read_frame(reader)
+            if not data:
+                break
+            req = parse_request(data) # text command or binary header, see framing.py
+            if req is None:
+                continue
+            if req.tag is not None: # tagged request: echo the tag ahead of the reply
+                writer.write(frame(f"@{req.tag}".encode()))
+
+            cmd = req.command
+
+            if cmd == "LIST": # LIST digests may hash files that have no sidecar yet
+                await write_frame(writer, await on_disk(dirCache.list_reply, req.names, bulk=bool(req.names)))
+
+            elif cmd == "LISTX":
+                await write_frame(writer, await on_disk(dirCache.listx_reply, req.names))
+
+            elif cmd in ("GET", "GET-IF-NONE-MATCH"): # the digest may need a full read
+                tag = req.names[1] if cmd == "GET-IF-NONE-MATCH" else None
+                await send_body(writer, *await on_disk(open_get, req.name, req.offset, req.length, tag, bulk=tag is not None))
+                await writer.drain()
+
+            elif cmd == "PUT": # PUT <file> <offset> resumes an upload
+                if req.refused is not None: # a name parse_request wouldn't accept
+                    f, refusal = None, req.refused
+                else:
+                    f, refusal, digest = await on_disk(open_put, req.name, req.offset or 0, bulk=bool(req.offset))
+                if f is None: # refused, still read the stream to stay in sync
+                    with open(os.devnull, "wb") as sink:
+                        received = await read_stream(reader, sink)
+                    if received is None:
+                        break
+                    await write_frame(writer, refusal)
+                    continue
+                try:
+                    received = await read_stream(reader, f, digest, executor=bulk_disk)
+                    if received is None:
+                        break # stream was cut short; the partial file is kept for RESUME
+                    try:
+                        await on_disk(fileStore.commit_upload, f, req.name, digest, bulk=True) # fsync and rename
+                        reply = b"Upload successful"
+                    except OSError as e: # e.g. PUT a when a/ is a directory; the whole body was read, so carry on
+                        reply = fileStore.upload_refusal(e)
+                finally:
+                    f.close() # after commit_upload already closed it, a no-op
+                await write_frame(writer, reply)
+
+            elif cmd == "MANIFEST": # a stat per file, plus a hash for any without a stored digest
+                writer.write(await on_disk(manifest.manifest_reply, req.names[0] if req.names else "", bulk=True))
+                await writer.drain()
+
+            elif cmd == "MGET":
+                await send_many(writer, req.names)
+
+            elif cmd == "RESUME": # both read the whole file for its sums
+                await write_frame(writer, await on_disk(fileStore.resume_reply, req.name, bulk=True))
+
+            elif cmd == "SUMS":
+                await write_frame(writer, await on_disk(fileStore.sums_reply, req.name, req.length, bulk=True))
+
+            else:
+                await write_frame(writer, b"Unknown or malformed command")
+    except (ConnectionError, FramingError):
+        pass
+    finally:
+        print(f"[-] Disconnected {addr}")
+        writer.close()
+
+async def serve(port, host="0.0.0.0", threads=diskPool.BULK_THREADS): # returns a started asyncio.Server
+    global quick_disk, bulk_disk
+    fileStore.init()
+    if quick_disk is None:
+        quick_disk = ThreadPoolExecutor(diskPool.QUICK_THREADS, thread_name_prefix="quick-disk")
+        bulk_disk = ThreadPoolExecutor(threads, thread_name_prefix="bulk-disk")
+    return await asyncio.start_server(handle_client, host, port)
+
+async def run(port, threads):
+    server = await serve(port, threads=threads)
+    print(f"[*] Server listening on port {port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage']:
+        params.usage()
+    metricsPort = int(paramMap['metricsPort'])
+    if metricsPort:
+        try:
+            metrics.serve(metricsPort)
+        except OSError as e:
+            print(f"[!] No metrics endpoint on port {metricsPort}: {e}")
+    asyncio.run(run(int(paramMap['listenPort']), int(paramMap['threads'])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+#! /usr/bin/env python3
+
+# Single-threaded server for the framed LIST/GET/PUT protocol.
+# One selectors (epoll on Linux) loop drives every connection; all protocol
+# state lives in each Conn so thousands of idle clients cost only a few objects.
+# The loop does no file I/O of its own: opens, reads, writes, fsyncs and
+# directory scans run on a diskPool, so one client's slow disk doesn't stall
+# the others. A GET keeps READ_AHEAD chunk reads in flight, and a PUT's body
+# is written behind the socket in batches of whatever arrived meanwhile.
+
+import errno, functools, os, resource, selectors, socket, sys, traceback
+from collections import deque
+sys.path.append("../lib")       # for params
+import params
+from framing import (FrameDecoder, FramingError, FRAME, CHUNK, CHUNK_SIZE,
+                     END_OF_STREAM, frame, stream_header, chunk_header, clip_range, parse_request)
+import fileStore
+import dirCache
+import manifest
+import diskPool
+import metrics
+import prefork
+
+switchesVarDefaults = (
+    (('-l', '--listenPort') ,'listenPort', 50001),
+    (('-w', '--workers'), 'workers', 1), # processes, each running its own loop; 1 = no supervisor
+    (('-r', '--reuseport'), "reuseport", False), # boolean: each worker binds its own SO_REUSEPORT socket
+    (('-t', '--threads'), 'threads', diskPool.BULK_THREADS), # disk threads for transfer bodies, per worker
+    (('-m', '--metricsPort'), 'metricsPort', 9102), # /metrics (disk queue depth and waits); 0 turns it off
+    (('-d', '--debug'), "debug", False), # boolean (set if present)
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+RECV_SIZE = 64 * 1024           # bytes asked for per recv()
+INBUF_CAP = 4 * RECV_SIZE       # stop reading from a client whose input isn't being consumed
+MAX_COMMAND = 64 * 1024         # a command frame longer than this is a protocol error
+READ_AHEAD = 2                  # chunk reads in flight per GET
+WRITE_BEHIND = 4 * 1024 * 1024  # PUT bytes received but not yet on disk before we stop reading
+
+sel = selectors.DefaultSelector()
+pool = None                     # the worker's diskPool.DiskPool
+listener = None                 # the worker's Listener
+debug = False
+
+def open_get(req): # on the pool: (file, status, offset, length, body); a small body is read here too
+    if req.command == "GET-IF-NONE-MATCH" and fileStore.digest_matches(req.name, req.names[1]):
+        return None, f"UNCHANGED {fileStore.DIGEST}={fileStore.file_digest(req.name)}".encode(), 0, 0, None
+    try:
+        f = open(fileStore.file_path(req.name), "rb")
+    except OSError:
+        return None, b"ERROR: File not found", 0, 0, None
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    if req.offset is None:
+        status, offset, length = fileStore.get_status(req.name, st), 0, size
+    else: # GET <file> <offset> <length>
+        byte_range = clip_range(req.offset, req.length, size)
+        if byte_range is None:
+            f.close()
+            return None, b"ERROR: Bad range", 0, 0, None
+        status, (offset, length) = fileStore.get_status(req.name, st, ranged=True), byte_range
+    if length > CHUNK_SIZE:
+        return f, status, offset, length, None
+    with f: # one job for the whole request
+        body = os.pread(f.fileno(), length, offset)
+    if len(body) < length:
+        raise ConnectionError("file truncated during GET")
+    return None, status, offset, length, body
+
+class Upload: # one PUT's partial file; its methods run on the pool, in order, through a Serial queue
+    def __init__(self, name, offset, refused=None): # refused: parse_request's reply for a bad name
+        self.name, self.offset, self.f, self.digest, self.refused = name, offset, None, None, refused
+        self.refusal = refused or b"ERROR: Cannot resume at that offset" # the reply if open doesn't get the file
+    def open(self):
+        if self.refused is not None:
+            return
+        try:
+            self.f = fileStore.open_upload(self.name, self.offset)
+        except OSError as e: # busy, or the name clashes with a directory
+            self.refusal = fileStore.upload_refusal(e)
+        if self.f is not None:
+            self.digest = fileStore.upload_digest(self.f, self.offset)
+    def write(self, data): # a refused PUT's stream is read and dropped to stay in sync
+        if self.f is not None:
+            self.f.write(data)
+            if self.digest is not None:
+                self.digest.update(data)
+        return len(data)
+    def commit(self): # the reply: the file is in place, or why it was refused
+        if self.f is None:
+            return self.refusal
+        f, self.f = self.f, None
+        try:
+            fileStore.commit_upload(f, self.name, self.digest)
+        except OSError as e: # e.g. PUT a when a/ is a directory; the whole body was read, so carry on
+            return fileStore.upload_refusal(e)
+        return b"Upload successful"
+    def abort(self): # the partial file stays behind so the client can resume it
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class Conn: # one client: input parser state, in-progress transfer, and output queue
+    def __init__(self, sock, addr):
+        self.sock, self.addr = sock, addr
+        self.decoder = FrameDecoder(MAX_COMMAND) # received but not yet handled
+        self.outq = deque()         # bytes-like objects to send
+        self.waiting = False        # a command's disk job is out; the reply comes from its callback
+        self.upload = self.putQueue = None # the PUT whose stream is being received or committed
+        self.putPending, self.putBuffered, self.putWriting = [], 0, False # write-behind
+        self.getFile = self.getOffset = self.getRemaining = None # getRemaining: bytes not yet asked for
+        self.ahead = deque()        # a GET's chunk reads in file order, [data] once done
+        self.getReads = 0           # of those still running; the file closes only when none are
+        self.readClosed = self.closed = False
+        self.events = selectors.EVENT_READ
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # a reply's frames mustn't wait on delayed ACKs
+        sel.register(sock, self.events, self)
+        if debug: print(f"[+] Connection from {addr}")
+
+    def busy(self): # a response is still being produced or going out, so hold off on parsing the next command
+        return len(self.outq) > 0 or self.getFile is not None or self.waiting
+
+    def updateInterest(self): # re-register only when readability/writability actually changes
+        if self.closed:
+            return
+        events = 0
+        if not self.readClosed and self.decoder.buffered() < INBUF_CAP:
+            events |= selectors.EVENT_READ
+        if self.outq: # not while a GET waits on its next read, the socket would just keep us spinning
+            events |= selectors.EVENT_WRITE
+        if events == 0 and self.readClosed and not self.busy():
+            self.close()
+            return
+        if events != self.events:
+            if not events:
+                sel.unregister(self.sock)
+            elif not self.events:
+                sel.register(self.sock, events, self)
+            else:
+                sel.modify(self.sock, events, self)
+            self.events = events
+
+    def proceed(self): # a disk job finished: carry on with output and pipelined commands
+        self.process()
+        self.updateInterest()
+
+    def doRecv(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        if data:
+            self.decoder.feed(data)
+        else:
+            self.readClosed = True
+        self.process()
+        if self.readClosed and self.decoder.streaming(): # client left mid-upload
+            self.close()
+            return
+        self.updateInterest()
+
+    def process(self): # consume as many decoder events as the current state allows
+        decoder = self.decoder
+        while not self.closed:
+            if decoder.streaming():
+                if self.putBuffered >= WRITE_BEHIND:
+                    return # the disk is behind, let the input back up
+            elif self.busy():
+                return # answer requests strictly in order
+            try:
+                event = decoder.next_event()
+            except FramingError:
+                self.close()
+                return
+            if event is None:
+                return
+            kind, data = event
+            if kind == FRAME:
+                self.handleCommand(data)
+            elif kind == CHUNK: # body bytes are queued for disk as soon as they arrive
+                self.putPending.append(data)
+                self.putBuffered += len(data)
+                self.flushPut()
+            else:
+                self.finishPut(data)
+
+    def handleCommand(self, data):
+        req = parse_request(data) # text command or binary header, see framing.py
+        if req is None:
+            return
+        if req.tag is not None: # tagged request: echo the tag ahead of the reply
+            self.outq.append(frame(f"@{req.tag}".encode()))
+        cmd = req.command
+        if cmd == "LIST": # LIST digests may hash files that have no sidecar yet
+            self.replyFrom(dirCache.list_reply, req.names, bulk=bool(req.names))
+        elif cmd == "LISTX":
+            self.replyFrom(dirCache.listx_reply, req.names)
+        elif cmd in ("GET", "GET-IF-NONE-MATCH"):
+            self.waiting = True
+            pool.submit(open_get, req, done=self.getOpened, bulk=cmd != "GET") # the digest may need a full read
+        elif cmd == "PUT": # PUT <file> <offset> resumes an upload
+            self.upload = Upload(req.name, req.offset or 0, req.refused)
+            self.putQueue = pool.serial()
+            self.putQueue.submit(self.upload.open)
+            self.decoder.start_stream()
+        elif cmd == "RESUME": # both read the whole file for its sums
+            self.replyFrom(fileStore.resume_reply, req.name, bulk=True)
+        elif cmd == "SUMS":
+            self.replyFrom(fileStore.sums_reply, req.name, req.length, bulk=True)
+        elif cmd == "MANIFEST": # already framed: a status frame and the manifest stream
+            self.replyFrom(manifest.manifest_reply, req.names[0] if req.names else "", bulk=True, framed=True)
+        else:
+            self.outq.append(frame(b"Unknown or malformed command"))
+
+    def replyFrom(self, fn, *args, bulk=False, framed=False): # the reply frame is whatever fn returns on the pool
+        self.waiting = True
+        pool.submit(fn, *args, done=functools.partial(self.replied, framed=framed), bulk=bulk)
+
+    def replied(self, reply, error, framed=False): # framed: reply is ready to send as it is
+        self.waiting = False
+        if self.failed(error):
+            return
+        self.outq.append(reply if framed else frame(reply))
+        self.proceed()
+
+    def failed(self, error): # True if a disk job's result is no use: we closed meanwhile, or it raised
+        if self.closed:
+            return True
+        if error is not None:
+            traceback.print_exception(error, file=sys.stdout)
+            self.close()
+            return True
+        return False
+
+    def getOpened(self, result, error):
+        self.waiting = False
+        if self.failed(error):
+            if result is not None and result[0] is not None:
+                result[0].close()
+            return
+        f, status, offset, length, body = result
+        if f is None and body is None:
+            self.outq.append(frame(status))
+        elif f is None: # small enough to have been read with the open
+            self.outq.append(frame(status) + stream_header(length) + (chunk_header(length) + body if length else b"") + END_OF_STREAM)
+        else:
+            self.outq.append(frame(status) + stream_header(length))
+            self.getFile, self.getOffset, self.getRemaining = f, offset, length
+            self.readAhead()
+        self.proceed()
+
+    def readAhead(self): # keep READ_AHEAD chunk reads of the GET in flight
+        while len(self.ahead) < READ_AHEAD and self.getRemaining:
+            length = min(CHUNK_SIZE, self.getRemaining)
+            slot = [None]
+            self.ahead.append(slot)
+            self.getReads += 1
+            pool.submit(os.pread, self.getFile.fileno(), length, self.getOffset,
+                        done=functools.partial(self.chunkRead, slot, length), bulk=True)
+            self.getOffset += length
+            self.getRemaining -= length
+
+    def chunkRead(self, slot, length, data, error):
+        self.getReads -= 1
+        if self.closed:
+            if not self.getReads: # the last read is back, the descriptor can't be reused under one now
+                self.getFile.close()
+            return
+        if error is None and len(data) < length: # file shrank under us
+            error = ConnectionError("file truncated during GET")
+        if self.failed(error):
+            return
+        slot[0] = data
+        if not self.outq:
+            self.refill()
+        self.updateInterest()
+
+    def refill(self): # queue the next chunk frame of an in-progress GET once it has been read
+        if self.ahead:
+            data = self.ahead[0][0]
+            if data is None:
+                return
+            self.ahead.popleft()
+            self.outq.append(chunk_header(len(data)))
+            self.outq.append(data)
+            self.readAhead()
+        elif not self.getRemaining:
+            self.getFile.close()
+            self.getFile = None
+            self.outq.append(END_OF_STREAM)
+
+    def flushPut(self, force=False): # hand buffered body bytes to the upload's queue
+        if self.putPending and (force or not self.putWriting):
+            pending = self.putPending
+            data = pending[0] if len(pending) == 1 else b"".join(pending)
+            self.putPending = []
+            self.putWriting = True
+            self.putQueue.submit(self.upload.write, data, done=self.putWritten)
+
+    def putWritten(self, n, error):
+        self.putWriting = False
+        if self.failed(error):
+            return
+        self.putBuffered -= n
+        self.flushPut()
+        self.proceed()
+
+    def finishPut(self, ok):
+        if not ok: # sender's total and chunks disagree; keep the partial file for RESUME
+            self.close()
+            return
+        self.flushPut(force=True)
+        self.waiting = True
+        self.putQueue.submit(self.upload.commit, done=self.putCommitted) # fsync and rename, behind the writes
+
+    def putCommitted(self, reply, error):
+        self.waiting = False
+        self.upload = self.putQueue = None
+        if self.failed(error):
+            return
+        self.outq.append(frame(reply))
+        self.proceed()
+
+    def abortPut(self): # whatever arrived is still written, then the partial file is closed
+        if self.upload is not None:
+            self.flushPut(force=True)
+            self.putQueue.submit(self.upload.abort)
+            self.upload = self.putQueue = None
+
+    def doSend(self):
+        outq = self.outq
+        try:
+            while True:
+                if not outq:
+                    if self.getFile is None:
+                        break
+                    self.refill()
+                    if not outq: # next chunk still being read
+                        break
+                item = outq[0]
+                n = self.sock.send(item)
+                if n < len(item):
+                    outq[0] = memoryview(item)[n:]
+                    continue
+                outq.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+            return
+        if not self.busy():
+            self.process() # pipelined commands may be waiting behind the response
+        self.updateInterest()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.abortPut()
+        if self.getFile is not None and not self.getReads:
+            self.getFile.close()
+        if self.events:
+            sel.unregister(self.sock)
+        self.sock.close()
+        listener.resume() # a descriptor is free again
+        if debug: print(f"[-] Disconnected {self.addr}")
+
+class DiskEvents: # the pool's wakeup socket: finished disk jobs hand their results back here
+    closed = False
+    def __init__(self):
+        sel.register(pool.fileno(), selectors.EVENT_READ, self)
+
+    def doRecv(self):
+        pool.run_completions()
+
+class Listener: # accepts clients from a listening socket and hands each one to a new Conn
+    def __init__(self, lsock):
+        self.lsock = lsock
+        lsock.setblocking(False)
+        sel.register(lsock, selectors.EVENT_READ, self)
+        self.paused = False
+
+    def resume(self): # a connection closed, so there may be a descriptor to accept with again
+        if self.paused:
+            sel.register(self.lsock, selectors.EVENT_READ, self)
+            self.paused = False
+
+    def doRecv(self):
+        while True: # drain the accept queue, a burst of clients needs only one wakeup
+            try:
+                csock, caddr = self.lsock.accept()
+            except BlockingIOError: # queue empty, or another worker sharing the socket took the client
+                return
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    continue # e.g. ECONNABORTED: that client gave up, try the next
+                # out of descriptors: the level-triggered listener would wake us forever, so stop
+                # watching it and leave the rest in the backlog until a connection closes
+                print(f"[!] Can't accept: {e}; pausing until a connection closes")
+                sel.unregister(self.lsock)
+                self.paused = True
+                return
+            Conn(csock, caddr)
+
+def main():
+    global debug
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage']:
+        params.usage()
+    debug = paramMap['debug']
+    listenAddr = ("0.0.0.0", int(paramMap['listenPort']))
+    workers = int(paramMap['workers'])
+    reuseport = paramMap['reuseport']
+    threads, metricsPort = int(paramMap['threads']), int(paramMap['metricsPort'])
+    fileStore.init()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE) # one descriptor per client, idle or not
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    lsock = None if reuseport else prefork.listen(listenAddr) # shared by every worker
+    print(f"[*] Server listening on port {listenAddr[1]}")
+    def worker():
+        global sel, pool, listener
+        sel = selectors.DefaultSelector() # an epoll set inherited across fork would be shared with the others
+        pool = diskPool.DiskPool(bulk_threads=threads) # threads don't survive a fork, so each worker starts its own
+        DiskEvents()
+        listener = Listener(lsock or prefork.listen(listenAddr, reuseport=True))
+        serve()
+    if workers > 1:
+        prefork.supervise(workers, worker)
+    else:
+        if metricsPort: # counters live in each process, so a prefork pool doesn't export them
+            try:
+                metrics.serve(metricsPort)
+            except OSError as e:
+                print(f"[!] No metrics endpoint on port {metricsPort}: {e}")
+        worker()
+
+def serve(): # the event loop
+    while True:
+        for key, mask in sel.select():
+            obj = key.data
+            try:
+                if mask & selectors.EVENT_READ:
+                    obj.doRecv()
+                if mask & selectors.EVENT_WRITE and not obj.closed:
+                    obj.doSend()
+            except Exception: # one misbehaving client must not take the loop down
+                traceback.print_exc(file=sys.stdout)
+                if isinstance(obj, Conn):
+                    obj.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,295 @@
 import socket
-import struct
+import threading
+import time
 import os
+import sys
+from framing import (send_framed, recv_framed, send_stream, recv_stream,
+                     chunk_sums, parse_sums, resume_offset, choose_codec, PREFERRED_CODECS,
+                     encode_request, text_request, CHUNK_SIZE, hash_file, reply_digest)
+import dedup
+import dirCache
 
 SERVER_HOST = "localhost"
 SERVER_PORT = 50000
+PARALLEL_STREAMS = 4 # connections PGET splits a file across
+MIN_SEGMENT = 8 * 1024 * 1024 # smaller files aren't worth splitting
+COMPRESS = True # offer compression to the server and compress uploads that benefit
+MGET_GROUP = 256 # names per MGET request in a batch
+BINARY_REQUESTS = True # binary request headers; -T sends text commands for servers that predate them
+VERBOSE = False # say when a transfer resumes; the interactive client turns it on, library callers stay quiet
 
-def send_framed(sock, data: bytes): # send framed data to socket
-    length = struct.pack("!I", len(data))
-    sock.sendall(length + data) # 
+switchesVarDefaults = (
+    (('-s', '--server'), 'server', "localhost:50000"),
+    (('-b', '--batch'), 'batch', False), # boolean: read GET/PUT lines from stdin and pipeline them
+    (('-T', '--text'), 'text', False), # boolean: send text commands instead of binary request headers
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
 
-def recv_all(sock, n): # read n bytes from socket
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data.extend(packet)
-    return bytes(data)
+def send_request(sock, command, names=(), tag=None, offset=None, length=None): # one request, in the chosen form
+    encode = encode_request if BINARY_REQUESTS else text_request
+    send_framed(sock, encode(command, names, tag, offset, length))
+
+def recv_reply(sock): # the next reply frame; a closed connection is an error rather than None
+    reply = recv_framed(sock)
+    if reply is None:
+        raise ConnectionError("server closed the connection")
+    return reply
 
-def recv_framed(sock): # read framed data from socket
-    length_data = recv_all(sock, 4)
-    if not length_data:
+def negotiate(sock): # returns the codec the server will also accept from us, or None
+    if not COMPRESS or not PREFERRED_CODECS:
         return None
-    length = struct.unpack("!I", length_data)[0]
-    return recv_all(sock, length)
+    send_request(sock, "CODECS", PREFERRED_CODECS)
+    reply = recv_reply(sock).decode().split()
+    if reply[0] != "OK" or len(reply) < 2 or reply[1] == "none":
+        return None # older servers answer with an error: stay uncompressed
+    return reply[1]
+
+class PositionalWriter: # file-like object whose writes land at a fixed offset with os.pwrite
+    def __init__(self, fd, offset):
+        self.fd, self.offset = fd, offset
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+
+def get_range(name, fd, offset, length): # one connection downloads one segment into place
+    with socket.create_connection((SERVER_HOST, SERVER_PORT)) as sock:
+        send_request(sock, "GET", [name], offset=offset, length=length)
+        status = recv_reply(sock)
+        if status.startswith(b"ERROR"):
+            return None
+        return recv_stream(sock, PositionalWriter(fd, offset))
+
+def parallel_get(sock, name, dest, streams=PARALLEL_STREAMS): # returns a message for the user
+    send_request(sock, "GET", [name], offset=0, length=0) # empty range: the reply only carries the size
+    status = recv_reply(sock)
+    if status.startswith(b"ERROR"):
+        return status.decode()
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        recv_stream(sock, PositionalWriter(fd, 0))
+        size = int(status.split()[1])
+        os.ftruncate(fd, size) # preallocate so each range is written in place
+        if hasattr(os, "posix_fallocate") and size:
+            try:
+                os.posix_fallocate(fd, 0, size) # reserve the blocks up front where supported
+            except OSError:
+                pass
+        segment = max(MIN_SEGMENT, -(-size // streams))
+        ranges = [(offset, min(segment, size - offset)) for offset in range(0, size, segment)]
+        results = [None] * len(ranges)
+        errors = [] # what went wrong on the connections that failed
+        def fetch(i):
+            offset, length = ranges[i]
+            try:
+                results[i] = get_range(name, fd, offset, length)
+                if results[i] != length:
+                    errors.append(f"bytes {offset}-{offset + length - 1}: incomplete")
+            except OSError as e:
+                errors.append(f"bytes {offset}-{offset + length - 1}: {e}")
+        threads = [threading.Thread(target=fetch, args=(i,)) for i in range(len(ranges))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        os.close(fd)
+    if any(results[i] != ranges[i][1] for i in range(len(ranges))):
+        return f"Download interrupted ({errors[0]})."
+    return f"File downloaded over {len(ranges)} connection(s)."
+
+def put_file(sock, filename, codec=None, name=None): # upload as name (default: the base name), continuing an interrupted attempt
+    name = name or os.path.basename(filename)
+    with open(filename, "rb") as f: # open file in READ binary mode
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        if size > CHUNK_SIZE: # resume points are chunk boundaries, so a smaller file always starts over
+            send_request(sock, "RESUME", [name])
+            reply = recv_reply(sock)
+            if reply.startswith(b"OK"): # compare chunk sums to skip what already arrived intact
+                partial_size, remote_sums = parse_sums(reply[2:].decode())
+                offset = resume_offset(min(partial_size, size), remote_sums, chunk_sums(f, len(remote_sums)))
+        if offset and VERBOSE:
+            print(f"Resuming upload at byte {offset}.")
+        send_request(sock, "PUT", [name], offset=offset or None)
+        f.seek(offset)
+        send_stream(sock, f, size - offset, codec=choose_codec(filename, f, codec)) # streamed chunk by chunk
+    return recv_reply(sock).decode()
+
+def delta_put(sock, filename): # DPUT: send chunk digests first, then only the chunks the server lacks
+    name = os.path.basename(filename)
+    with open(filename, "rb") as f:
+        chunks = list(dedup.cdc_chunks(f))
+        send_request(sock, "DPUT", [name])
+        send_framed(sock, dedup.encode_manifest((d, n) for offset, n, d in chunks))
+        status = recv_reply(sock)
+        if not status.startswith(b"OK"):
+            return status.decode()
+        missing = [i for (i,) in dedup.INDEX.iter_unpack(recv_reply(sock))]
+        for i in missing:
+            offset, n, d = chunks[i]
+            f.seek(offset)
+            send_framed(sock, f.read(n))
+    return recv_reply(sock).decode()
+
+def list_details(sock, pattern=None, page=dirCache.DEFAULT_PAGE): # yields (name, size, mtime_ns), one LISTX page at a time
+    after = ""
+    while True:
+        if BINARY_REQUESTS:
+            send_request(sock, "LISTX", [after, pattern or ""], length=page)
+        else:
+            send_request(sock, "LISTX", [f"limit={page}"] + [f"{key}={value}" for key, value in (("after", after), ("glob", pattern)) if value])
+        reply = recv_framed(sock)
+        if not reply.startswith(b"OK"):
+            raise ValueError(reply.decode())
+        entries, more = dirCache.parse_listx(reply)
+        yield from entries
+        if not more or not entries:
+            return
+        after = entries[-1][0]
+
+def get_file(sock, name, dest, local_digest=None): # download into dest.part, resuming it if one is left over; skipped if dest is current
+    # local_digest: dest's SHA-256 if the caller already knows it, saving a pass over the file; False if dest is stale
+    part = dest + ".part"
+    offset = 0
+    if os.path.exists(part):
+        with open(part, "rb") as f:
+            local_size = os.fstat(f.fileno()).st_size
+            local_sums = chunk_sums(f)
+        send_request(sock, "SUMS", [name], length=len(local_sums))
+        reply = recv_reply(sock)
+        if reply.startswith(b"OK"):
+            remote_size, remote_sums = parse_sums(reply[2:].decode())
+            offset = resume_offset(min(local_size, remote_size), remote_sums, local_sums)
+    if offset:
+        if VERBOSE:
+            print(f"Resuming download at byte {offset}.")
+        send_request(sock, "GET", [name], offset=offset, length=1 << 62) # ranged GET of the rest
+    elif local_digest is not False and os.path.exists(dest): # the server sends no body if our copy has the digest it stores
+        if local_digest is None:
+            with open(dest, "rb") as f:
+                local_digest = hash_file(f).hexdigest()
+        send_request(sock, "GET-IF-NONE-MATCH", [name, local_digest])
+    else:
+        send_request(sock, "GET", [name])
+    status = recv_reply(sock) # server answers OK or ERROR before the stream
+    if status.startswith(b"Unknown"): # a server without GET-IF-NONE-MATCH: fetch it anyway
+        send_request(sock, "GET", [name])
+        status = recv_reply(sock)
+    if status.startswith(b"UNCHANGED"):
+        return "File unchanged."
+    if status.startswith(b"ERROR"):
+        return status.decode()
+    expected = reply_digest(status)
+    with open(part, "r+b" if offset else "wb") as f:
+        f.truncate(offset)
+        f.seek(offset)
+        digest = hash_file(f, offset) # the resumed part's digest, continued as the rest arrives
+        received = recv_stream(sock, f, digest=digest)
+    if received is None:
+        return None # keep dest.part for the next attempt
+    if expected is not None and digest.hexdigest() != expected:
+        os.remove(part) # the next attempt starts over rather than resuming from bad data
+        return "ERROR: Download does not match the server's digest, discarded"
+    os.replace(part, dest) # only a complete download takes the real name
+    return "File downloaded."
+
+def batch_requests(jobs): # groups (verb, name) jobs into requests: runs of GETs become MGETs
+    requests = []
+    for verb, name in jobs:
+        if verb == "GET" and requests and requests[-1][0] == "MGET" and len(requests[-1][1]) < MGET_GROUP:
+            requests[-1][1].append(name)
+        elif verb == "GET":
+            requests.append(("MGET", [name]))
+        else:
+            requests.append(("PUT", name))
+    return requests
+
+def send_batch(sock, requests, codec): # sender side of a pipelined batch: never waits for a reply
+    for tag, (verb, arg) in enumerate(requests):
+        if verb == "MGET":
+            send_request(sock, "MGET", arg, tag=tag)
+            continue
+        with open(arg, "rb") as f:
+            send_request(sock, "PUT", [os.path.basename(arg)], tag=tag)
+            send_stream(sock, f, os.fstat(f.fileno()).st_size, codec=choose_codec(arg, f, codec))
+
+def run_batch(sock, jobs, codec=None): # pipelines jobs over sock; yields (verb, name, message) as replies arrive
+    requests = batch_requests(jobs)
+    failed = []
+    def sender():
+        try:
+            send_batch(sock, requests, codec)
+        except Exception as e: # e.g. a PUT file that went away: the reader would wait forever for its tag
+            failed.append(e)
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # so wake it up with end of file
+            except OSError:
+                pass
+    t = threading.Thread(target=sender, daemon=True)
+    t.start()
+    for tag, (verb, arg) in enumerate(requests):
+        echoed = recv_framed(sock) # replies come back in request order, each behind its tag
+        if echoed is None:
+            raise ConnectionError(f"connection lost: {failed[0] if failed else 'server closed'}")
+        if echoed != f"@{tag}".encode():
+            raise ConnectionError(f"expected reply to @{tag}, got {bytes(echoed[:40])!r}")
+        if verb == "PUT":
+            yield verb, arg, recv_framed(sock).decode()
+            continue
+        status = recv_framed(sock).decode()
+        if not status.startswith("OK"):
+            for name in arg:
+                yield "GET", name, status
+            continue
+        for name in arg:
+            status = recv_framed(sock).decode()
+            if status.startswith("ERROR"):
+                yield "GET", name, status
+                continue
+            part = name + ".part"
+            with open(part, "wb") as f:
+                received = recv_stream(sock, f)
+            if received is None:
+                raise ConnectionError("download interrupted")
+            os.replace(part, name)
+            yield "GET", name, f"{received} bytes"
+    t.join()
+
+def read_jobs(lines): # batch input: one "GET <file>" or "PUT <file>" per line
+    jobs = []
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 2 and tokens[0].upper() == "PUT" and not os.path.isfile(tokens[1]):
+            print(f"Skipping PUT of a missing file: {tokens[1]}")
+        elif len(tokens) == 2 and tokens[0].upper() in ("GET", "PUT"):
+            jobs.append((tokens[0].upper(), tokens[1]))
+        elif tokens:
+            print(f"Skipping malformed line: {line.strip()}")
+    return jobs
 
 def main(): # main function to handle client commands
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock: # create socket using IPv4 and TCP
         sock.connect((SERVER_HOST, SERVER_PORT)) #Connects to the server
         print(f"[*] Connected to server at {SERVER_HOST}:{SERVER_PORT}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # small pipelined requests go out at once
+        codec = negotiate(sock)
+        if codec:
+            print(f"[*] Compressing with {codec}")
+
+        if paramMap['batch']:
+            start = time.perf_counter()
+            count = 0
+            for verb, name, message in run_batch(sock, read_jobs(sys.stdin), codec):
+                print(f"{verb} {name}: {message}")
+                count += 1
+            print(f"[*] {count} requests in {time.perf_counter() - start:.2f}s")
+            return
 
         while True:
-            cmd = input("Enter command (LIST, GET <file>, PUT <file>, QUIT): ").strip()
+            cmd = input("Enter command (LIST, GET <file>, MGET <files>, PGET <file> [streams], PUT <file>, MPUT <files>, DPUT <file>, LS [glob], SYNC PUSH|PULL <dir> [remote], QUIT): ").strip()
             if not cmd:
                 continue
 
@@ -45,27 +303,72 @@ def main(): # main function to handle client commands
                 if not os.path.exists(filename):
                     print("File does not exist.")
                     continue
-                send_framed(sock, cmd.encode()) # send command to server
-                with open(filename, "rb") as f: # open file in READ binary mode
-                    send_framed(sock, f.read()) 
-                response = recv_framed(sock)
-                print(response.decode())
+                print(put_file(sock, filename, codec))
+
+            elif tokens[0].upper() == "DPUT" and len(tokens) == 2: # upload only what changed
+                if not os.path.exists(tokens[1]):
+                    print("File does not exist.")
+                    continue
+                try:
+                    print(delta_put(sock, tokens[1]))
+                except ConnectionError as e: # nothing more can be asked on this connection
+                    print(f"DPUT failed: {e}")
+                    break
 
             elif tokens[0].upper() == "GET" and len(tokens) == 2:
-                send_framed(sock, cmd.encode())
-                data = recv_framed(sock) # receive data from server
-                if data.startswith(b"ERROR"): 
-                    print(data.decode())
-                else:
-                    with open(tokens[1], "wb") as f: # open file in WRITE binary mode
-                        f.write(data)
-                    print("File downloaded.")
+                result = get_file(sock, tokens[1], tokens[1])
+                if result is None:
+                    print("Download interrupted, GET it again to resume.")
+                    break
+                print(result)
+
+            elif tokens[0].upper() in ("MGET", "MPUT") and len(tokens) >= 2: # many files, pipelined
+                verb = tokens[0].upper()[1:]
+                missing = [name for name in tokens[1:] if verb == "PUT" and not os.path.exists(name)]
+                if missing:
+                    print(f"File does not exist: {missing[0]}")
+                    continue
+                for verb, name, message in run_batch(sock, [(verb, name) for name in tokens[1:]], codec):
+                    print(f"{name}: {message}")
+
+            elif tokens[0].upper() == "PGET" and len(tokens) in (2, 3): # segmented download over several connections
+                streams = int(tokens[2]) if len(tokens) == 3 and tokens[2].isdigit() else PARALLEL_STREAMS
+                try:
+                    print(parallel_get(sock, tokens[1], tokens[1], max(1, streams)))
+                except ConnectionError as e:
+                    print(f"PGET failed: {e}")
+                    break
+
+            elif tokens[0].upper() == "LS" and len(tokens) in (1, 2): # names with size and mtime, paged
+                try:
+                    for name, size, mtime_ns in list_details(sock, tokens[1] if len(tokens) == 2 else None):
+                        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime_ns / 1e9))
+                        print(f"{size:>14} {stamp} {name}")
+                except ValueError as e:
+                    print(e)
+
+            elif tokens[0].upper() == "SYNC" and len(tokens) in (3, 4) and tokens[1].upper() in ("PUSH", "PULL"):
+                import treeSync # imported here: it builds on this module through clientPool
+                try:
+                    treeSync.sync(f"{SERVER_HOST}:{SERVER_PORT}", tokens[1].lower(), tokens[2],
+                                  tokens[3] if len(tokens) == 4 else "")
+                except (OSError, ValueError) as e:
+                    print(f"Sync failed: {e}")
 
             elif tokens[0].upper() == "LIST":
-                send_framed(sock, cmd.encode())
+                send_request(sock, "LIST")
                 data = recv_framed(sock) #reads the framed response
                 print("Files on server:\n", data.decode())
             else:
                 print("Unknown or malformed command.")
-if __name__ == "__main__":
+if __name__ == "__main__": # params is only for the command line: importing it consumes sys.argv
+    sys.path.append("../lib")       # for params
+    import params
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage']:
+        params.usage()
+    SERVER_HOST, port = paramMap['server'].rsplit(":", 1)
+    SERVER_PORT = int(port)
+    BINARY_REQUESTS = not paramMap['text']
+    VERBOSE = True
     main()
\ No newline at end of file
@@ -1,83 +1,243 @@
 import socket
 import threading
 import os
-import struct
+from framing import (send_framed, recv_framed, send_stream, recv_stream, clip_range, pick_codec, choose_codec,
+                     frame, parse_request)
+import fileStore
+import dirCache
+import manifest
+import dedup
+import hotCache
+import metrics
+import pacing
+import prefork
 
 HOST = "0.0.0.0"
 PORT = 50001
-SERVER_FILES_DIR = "server-files"
-os.makedirs(SERVER_FILES_DIR, exist_ok=True)
-
-# accurately reconstruct complete messages regardless of how they're fragmented
-def send_framed(sock, data: bytes): 
-    length = struct.pack("!I", len(data)) # standard network byte order
-    sock.sendall(length + data) # tells receiver exactly how many bytes to expect
-
-def recv_all(sock, n): #collects all the pieces until it has the complete message
-    data = bytearray()
-    while len(data) < n:
-        packet = sock.recv(n - len(data)) # remaining number of bytes we still need
-        if not packet:
-            return None
-        data.extend(packet) # adds the newly received bytes to the existing data
-    return bytes(data)
-
-def recv_framed(sock): # receives the length header and then the message
-    length_data = recv_all(sock, 4) #first reading the 4-byte length header
-    if not length_data:
-        return None
-    length = struct.unpack("!I", length_data)[0] #uses length to read the exact # of bytes message
-    return recv_all(sock, length)
+WORKERS = 1 # processes sharing the listening socket; more than 1 forks a prefork.supervise pool
+USE_MMAP = False # large GET and PUT bodies go through an mmap of the file (see benchMmap.py)
+MGET_BATCH = 256 * 1024 # small MGET files are gathered into writes of about this size
+METRICS_PORT = 9101 # http://localhost:9101/metrics; 0 turns it off
+STATS_INTERVAL = 0 # seconds between one-line stats on stdout, 0 for none
+GLOBAL_RATE = 0 # bytes/s all clients share, scheduled fairly between connections; 0 = unlimited
+CLIENT_RATE = 0 # bytes/s per client address; 0 = unlimited
+CLIENT_WEIGHTS = {} # client address -> its share of GLOBAL_RATE relative to the default of 1
+fileStore.init()
+dedup.init()
+pacer = None # set up in main() from the rates above
+metrics.collectors.append(lambda: [f"ft_hot_cache_{key} {value}" for key, value in hotCache.cache.counters().items()])
+
+def send_many(conn, names, codec): # MGET: per file an OK frame and stream, or an ERROR frame
+    send_framed(conn, f"OK {len(names)}".encode())
+    out = bytearray() # small files are batched so each one isn't several tiny writes
+    for name in names:
+        path = fileStore.file_path(name)
+        if not os.path.isfile(path):
+            out += frame(b"ERROR: File not found")
+            continue
+        reply = hotCache.cached_reply(name, codec) # small files come whole from the hot cache
+        if reply is not None:
+            out += reply
+        else: # big ones go out as a normal stream
+            with open(path, "rb") as f:
+                out += frame(fileStore.get_status(name, os.fstat(f.fileno())))
+                conn.sendall(out)
+                out.clear()
+                send_stream(conn, f, os.fstat(f.fileno()).st_size, codec=choose_codec(path, f, codec), use_mmap=USE_MMAP)
+        if len(out) >= MGET_BATCH:
+            conn.sendall(out)
+            out.clear()
+    conn.sendall(out)
+
+class Session: # one client's connection and the state its requests share
+    def __init__(self, conn, meter):
+        self.conn, self.meter = conn, meter
+        self.codec = None # compression this client accepted with CODECS, None for raw
+
+# Handlers take the session and a framing.Request. One returns False when the
+# connection can't go on (a stream was cut short), anything else to carry on.
+
+def do_list(session, req): #get all filenames in its storage directory, LIST digests with their SHA-256
+    send_framed(session.conn, dirCache.list_reply(req.names)) # names joined with newlines, from the directory cache
+
+def do_listx(session, req): #one page of names with size and mtime, in a compact binary form
+    send_framed(session.conn, dirCache.listx_reply(req.names))
+
+def do_get(session, req): #client wants to download a file or a range of it
+    conn = session.conn
+    codec = session.codec if req.codec is False else req.codec
+    path = fileStore.file_path(req.name)
+    if not os.path.isfile(path): #check if the file exists
+        send_framed(conn, b"ERROR: File not found")
+        metrics.error("not_found")
+        return
+    reply = hotCache.cached_reply(req.name, codec) if req.offset is None else None
+    if reply is not None: # small hot file: OK frame and stream straight from memory
+        conn.sendall(reply)
+        return
+    with session.meter.file(open(path, "rb")) as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if req.offset is None:
+            send_framed(conn, fileStore.get_status(req.name, st)) # status frame, then the file as a stream
+            send_stream(conn, f, size, codec=choose_codec(path, f, codec), use_mmap=USE_MMAP)
+            return
+        byte_range = clip_range(req.offset, req.length, size) # GET <file> <offset> <length>
+        if byte_range is None:
+            send_framed(conn, b"ERROR: Bad range")
+            metrics.error("bad_range")
+            return
+        offset, length = byte_range
+        f.seek(offset)
+        send_framed(conn, fileStore.get_status(req.name, st, ranged=True)) # full size lets the client plan its ranges
+        send_stream(conn, f, length, codec=choose_codec(path, f, codec), use_mmap=USE_MMAP)
+
+def do_put(session, req): #client wants to upload a file, PUT <file> <offset> resumes one
+    conn, meter = session.conn, session.meter
+    refusal, error = b"ERROR: Cannot resume at that offset", "bad_resume"
+    if req.refused is not None: # a name parse_request wouldn't accept
+        f, refusal, error = None, req.refused, "bad_path"
+    else:
+        with meter.disk_time():
+            try:
+                f = fileStore.open_upload(req.name, req.offset or 0)
+            except OSError as e: # busy, or the name clashes with a directory
+                f, refusal, error = None, fileStore.upload_refusal(e), "upload_refused"
+            digest = fileStore.upload_digest(f, req.offset or 0) if f is not None else None
+    if f is None: # refused, still read the stream to stay in sync
+        with open(os.devnull, "wb") as sink:
+            received = recv_stream(conn, sink)
+        if received is None:
+            metrics.error("stream_interrupted")
+            return False
+        send_framed(conn, refusal)
+        metrics.error(error)
+        return
+    with meter.file(f) as f:
+        received = recv_stream(conn, f, use_mmap=USE_MMAP, digest=digest) # Writes the file chunk by chunk as it arrives
+        if received is None:
+            metrics.error("stream_interrupted")
+            return False # stream was cut short; the partial file is kept so the client can resume
+        try:
+            with meter.disk_time(): # fsync and rename
+                fileStore.commit_upload(f, req.name, digest) # rename into place only once it is complete
+        except OSError as e: # e.g. PUT a when a/ is a directory; the whole body was read, so carry on
+            send_framed(conn, fileStore.upload_refusal(e))
+            metrics.error("upload_refused")
+            return
+    dedup.index.forget(req.name) # its old chunks are gone
+    send_framed(conn, b"Upload successful")
+
+def do_get_if_none_match(session, req): #GET unless the client's copy has this digest
+    with session.meter.disk_time(): # may hash the file once if no digest is stored for it yet
+        unchanged = fileStore.digest_matches(req.name, req.names[1])
+    if unchanged:
+        send_framed(session.conn, f"UNCHANGED {fileStore.DIGEST}={fileStore.file_digest(req.name)}".encode())
+        return
+    req.names = req.names[:1]
+    return do_get(session, req)
+
+def do_manifest(session, req): #every file under a directory with size, mtime and digest, for tree sync
+    with session.meter.disk_time(): # a stat per file, plus a hash for any without a stored digest
+        reply = manifest.manifest_reply(req.names[0] if req.names else "", session.codec if req.codec is False else req.codec)
+    session.conn.sendall(reply)
+
+def do_dput(session, req): #delta upload: only chunks the server lacks are sent
+    if req.refused is not None: # read its manifest frame so the next request starts in step
+        if recv_framed(session.conn) is None:
+            metrics.error("stream_interrupted")
+            return False
+        send_framed(session.conn, req.refused)
+        metrics.error("bad_path")
+        return
+    reply = dedup.serve_delta_put(session.conn, req.name)
+    if reply is None:
+        metrics.error("stream_interrupted")
+        return False
+    send_framed(session.conn, reply)
+
+def do_mget(session, req): #many files streamed back in one response
+    send_many(session.conn, req.names, session.codec if req.codec is False else req.codec)
+
+def do_codecs(session, req): #client lists the codecs it can decode, best first; we pick one for our sends
+    session.codec = pick_codec(req.names)
+    send_framed(session.conn, f"OK {session.codec or 'none'}".encode())
+
+def do_stats(session, req): #hot cache counters (everything else is at METRICS_PORT)
+    send_framed(session.conn, hotCache.stats_reply())
+
+def do_resume(session, req): #how much of an interrupted upload the server already has
+    send_framed(session.conn, fileStore.resume_reply(req.name))
+
+def do_sums(session, req): #chunk checksums of a stored file, to resume a download
+    send_framed(session.conn, fileStore.sums_reply(req.name, req.length))
+
+HANDLERS = {"LIST": do_list, "LISTX": do_listx, "GET": do_get, "PUT": do_put, "DPUT": do_dput, "MGET": do_mget,
+            "CODECS": do_codecs, "STATS": do_stats, "RESUME": do_resume, "SUMS": do_sums,
+            "GET-IF-NONE-MATCH": do_get_if_none_match, "MANIFEST": do_manifest}
 
 def handle_client(conn, addr):
     print(f"[+] Connection from {addr}")
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # pipelined replies are many small frames
+    paced = pacer is not None and pacer.enabled()
+    if paced:
+        conn = pacer.socket(conn, addr) # sends wait for this client's and the global share
+    meter = metrics.Meter(conn)
+    conn = meter.sock # same socket, with its bytes and time charged to the request in progress
+    session = Session(conn, meter)
     try:
         while True:
             data = recv_framed(conn) #receives the length header and then the message
             if not data:
                 break
-            # Decode the data and split it into command and arguments
-            command_parts = data.decode().strip().split()
-            if not command_parts:
+            req = parse_request(data) # text command or binary header, see framing.py
+            if req is None:
                 continue
-
-            cmd = command_parts[0] #first part is the command
-
-            if cmd == "LIST": #get all filenames in its storage directory
-                files = "\n".join(os.listdir(SERVER_FILES_DIR)) # Joins them into a single string with newlines as separators
-                send_framed(conn, files.encode()) #Encodes this string into bytes and sends it back framed
-
-            elif cmd == "GET" and len(command_parts) == 2: #client wants to download a file
-                filename = command_parts[1] 
-                path = os.path.join(SERVER_FILES_DIR, filename) 
-                if os.path.exists(path): #check if the file exists
-                    with open(path, "rb") as f:
-                        send_framed(conn, f.read()) # Reads the file and sends it back framed
-                else:
-                    send_framed(conn, b"ERROR: File not found")
-
-            elif cmd == "PUT" and len(command_parts) == 2: #client wants to upload a file
-                filename = command_parts[1]
-                filedata = recv_framed(conn) # Receives the file data
-                with open(os.path.join(SERVER_FILES_DIR, filename), "wb") as f:
-                    f.write(filedata) # Writes the received data to a file
-                send_framed(conn, b"Upload successful")
-
-            else:
-                send_framed(conn, b"Unknown or malformed command")
+            if req.tag is not None: # tagged request: echo the tag as a frame ahead of the reply
+                send_framed(conn, f"@{req.tag}".encode())
+            handler = HANDLERS.get(req.command)
+            meter.begin()
+            try:
+                if handler is None:
+                    send_framed(conn, b"Unknown or malformed command")
+                    metrics.error("bad_command")
+                elif handler(session, req) is False:
+                    break
+            finally:
+                meter.end(req.command if handler is not None else "other")
+    except Exception as e:
+        metrics.error(type(e).__name__)
+        raise
     finally:
+        meter.close()
+        if paced:
+            pacer.release(addr)
         print(f"[-] Disconnected {addr}") # Close the connection
         conn.close()
 
+def accept_loop(s):
+    while True:
+        conn, addr = s.accept() # Accept a new connection
+        thread = threading.Thread(target=handle_client, args=(conn, addr)) # Create a new thread for each client
+        thread.start() # Start the thread to handle the client
+
 def main():
+    global pacer
     print(f"[*] Server listening on port {PORT}")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT)) # Bind the socket to the host and port
-        s.listen() # Listen for incoming connections
-        while True:
-            conn, addr = s.accept() # Accept a new connection
-            thread = threading.Thread(target=handle_client, args=(conn, addr)) # Create a new thread for each client
-            thread.start() # Start the thread to handle the client
+    pacer = pacing.Pacer(GLOBAL_RATE, CLIENT_RATE, CLIENT_WEIGHTS)
+    if WORKERS == 1: # counters live in each process, so a prefork pool doesn't export them
+        if METRICS_PORT:
+            try:
+                metrics.serve(METRICS_PORT)
+            except OSError as e: # serving files matters more than exporting numbers about it
+                print(f"[!] No metrics endpoint on port {METRICS_PORT}: {e}")
+        if STATS_INTERVAL:
+            metrics.log_every(STATS_INTERVAL)
+    with prefork.listen((HOST, PORT)) as s: # Bind the socket to the host and port and listen
+        if WORKERS > 1: # each worker has its own dedup index, loaded at startup (see dedup.py)
+            prefork.supervise(WORKERS, lambda: accept_loop(s))
+        else:
+            accept_loop(s)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,619 @@
+# Framing shared by the file transfer clients and servers.
+#
+# A frame is a 4-byte big-endian length followed by that many bytes.
+# A stream (a file body) is an 8-byte total length, then chunk frames of at
+# most CHUNK_SIZE bytes, then an empty frame marking the end. The top byte of
+# a chunk frame's length names the codec its payload is compressed with.
+#
+# FrameDecoder is a sans-IO parser usable from any event loop; the send_/recv_
+# functions work on blocking sockets; the read_/write_ coroutines adapt the
+# same layout to asyncio StreamReader/StreamWriter pairs.
+
+import os
+import mmap
+import hashlib
+import struct
+import zlib
+import lzma
+import asyncio
+try:
+    import zstandard            # optional, much faster than zlib at similar ratios
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame            # optional, fastest and lightest
+except ImportError:
+    lz4 = None
+
+CHUNK_SIZE = 1024 * 1024 # largest payload of one chunk frame in a streamed transfer
+MAX_FRAME = 64 * 1024 * 1024 # largest non-stream frame a decoder will buffer
+USE_SENDFILE = hasattr(os, "sendfile") # let the kernel copy file bodies straight to the socket
+MMAP_THRESHOLD = 64 * 1024 * 1024 # use_mmap only maps bodies at least this big
+
+FRAME_HEADER = struct.Struct("!I")
+STREAM_HEADER = struct.Struct("!Q")
+END_OF_STREAM = FRAME_HEADER.pack(0) # zero-length frame marks the end of a stream
+
+class FramingError(Exception): # peer sent something that can't be valid framing
+    pass
+
+def frame(data: bytes): # a whole frame, ready to send
+    return FRAME_HEADER.pack(len(data)) + data
+
+def stream_header(total): # first bytes of a stream
+    return STREAM_HEADER.pack(total)
+
+def chunk_header(length): # header of one chunk frame inside a stream
+    return FRAME_HEADER.pack(length)
+
+# ---- compression ----
+#
+# Chunks are compressed one at a time, so memory stays at one chunk and a
+# chunk that doesn't shrink just goes out as is (codec 0). Which codec a
+# sender may use is negotiated per connection with CODECS.
+
+CODEC_SHIFT = 24                # chunk header: codec << CODEC_SHIFT | payload length
+LENGTH_MASK = (1 << CODEC_SHIFT) - 1
+SAMPLE_SIZE = 64 * 1024         # bytes test-compressed to decide whether a file is worth it
+MIN_SAVING = 0.1                # skip compression unless the sample shrinks by this much
+COMPRESSED_EXTENSIONS = {".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".lz4", ".zip", ".7z",
+                         ".rar", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4",
+                         ".mkv", ".mov", ".avi", ".pdf", ".docx", ".xlsx", ".pptx"}
+
+def _bounded(decompressor, data): # decompress one chunk, refusing to expand past CHUNK_SIZE
+    out = decompressor.decompress(data, CHUNK_SIZE)
+    if not decompressor.eof:
+        raise FramingError("compressed chunk is corrupt or expands past CHUNK_SIZE")
+    return out
+
+CODECS = { # name -> (id, compress, decompress), in order of preference
+    "zlib": (1, lambda data: zlib.compress(data, 1),
+             lambda data: _bounded(zlib.decompressobj(), data)),
+    "lzma": (2, lambda data: lzma.compress(data, preset=1),
+             lambda data: _bounded(lzma.LZMADecompressor(), data)),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (3, zstandard.ZstdCompressor(level=3).compress,
+                      lambda data: zstandard.ZstdDecompressor().decompress(data, max_output_size=CHUNK_SIZE))
+if lz4 is not None:
+    CODECS["lz4"] = (4, lz4.frame.compress, lz4.frame.decompress)
+PREFERRED_CODECS = [name for name in ("zstd", "lz4", "zlib", "lzma") if name in CODECS]
+DECOMPRESSORS = {codec_id: decompress for codec_id, compress, decompress in CODECS.values()}
+
+def pick_codec(offered): # CODECS <name> ...: the first offered codec we also have, or None
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+def choose_codec(path, f, codec): # codec to use for this file, None if it already looks compressed
+    if codec is None or os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    offset = f.tell()
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(offset)
+    if len(sample) < 512: # too small to bother
+        return None
+    if len(CODECS[codec][1](sample)) > len(sample) * (1 - MIN_SAVING):
+        return None
+    return codec
+
+def encode_chunk(chunk, codec): # chunk header and payload, compressed when that helps
+    if codec is not None:
+        codec_id, compress, decompress = CODECS[codec]
+        packed = compress(chunk)
+        if len(packed) < len(chunk):
+            return FRAME_HEADER.pack(codec_id << CODEC_SHIFT | len(packed)) + packed
+    return chunk_header(len(chunk)) + chunk
+
+def decode_chunk(codec_id, payload): # raw bytes of a compressed chunk
+    decompress = DECOMPRESSORS.get(codec_id)
+    if decompress is None:
+        raise FramingError("unknown codec %d" % codec_id)
+    try:
+        data = decompress(payload)
+    except FramingError:
+        raise
+    except Exception as e: # each codec library has its own error types
+        raise FramingError("can't decompress chunk: %s" % e)
+    if len(data) > CHUNK_SIZE:
+        raise FramingError("compressed chunk expands past CHUNK_SIZE")
+    return data
+
+def clip_range(offset, length, size): # GET <file> <offset> <length> -> (offset, length) clipped to the file
+    if offset < 0 or length < 0 or offset > size:
+        return None
+    return offset, min(length, size - offset)
+
+def chunk_sums(f, count=None): # CRC32 of each CHUNK_SIZE block of f from the start, at most count of them
+    sums = []
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    f.seek(0)
+    while count is None or len(sums) < count:
+        n = f.readinto(buf)
+        if not n:
+            break
+        sums.append(zlib.crc32(view[:n]))
+    return sums
+
+DIGEST = "sha256" # whole-file digest the servers store and put in GET replies as sha256=<hex>
+
+def hash_file(f, length=None): # hashlib object fed the first length bytes of f (all of it if None), read with pread
+    digest = hashlib.new(DIGEST)
+    pos = 0
+    while length is None or pos < length:
+        data = os.pread(f.fileno(), CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - pos), pos)
+        if not data:
+            break
+        digest.update(data)
+        pos += len(data)
+    return digest
+
+def reply_digest(status): # hex digest carried by an OK or UNCHANGED reply, None if it has none
+    for token in bytes(status).split()[1:]:
+        if token.startswith(DIGEST.encode() + b"="):
+            return token[len(DIGEST) + 1:].decode()
+    return None
+
+def format_sums(size, sums): # "<size> <crc> <crc> ..." as carried by RESUME and SUMS replies
+    return " ".join([str(size)] + ["%08x" % crc for crc in sums])
+
+def parse_sums(text): # inverse of format_sums
+    fields = text.split()
+    return int(fields[0]), [int(crc, 16) for crc in fields[1:]]
+
+def resume_offset(size, remote_sums, local_sums): # chunk-aligned offset where the copies stop agreeing
+    good = 0
+    for remote, local in zip(remote_sums, local_sums):
+        if remote != local:
+            break
+        good += 1
+    return min(good * CHUNK_SIZE, size - size % CHUNK_SIZE)
+
+# ---- requests ----
+#
+# A request frame is either a text command, "[@<tag>] VERB arg ...", or a
+# binary header: the REQUEST_V1 byte (never the first byte of a text command,
+# which is ASCII), opcode, flags and path length, then the fields the flags
+# select, each fixed width and in this order: request id (echoed as an
+# @<id> frame ahead of the reply, like a text tag), offset, length, codec id;
+# then the UTF-8 path. Commands taking several names (MGET, CODECS, LISTX's
+# after and glob) separate them with NUL. Both forms parse to a Request.
+
+REQUEST_V1 = 0xF1               # binary request header, version 1
+REQUEST_HEADER = struct.Struct("!BBBH") # version, opcode, flags, path length
+REQ_TAG, REQ_OFFSET, REQ_LENGTH, REQ_CODEC = 1, 2, 4, 8 # flags: which optional fields follow
+_FIELDS = ((REQ_TAG, "I"), (REQ_OFFSET, "Q"), (REQ_LENGTH, "Q"), (REQ_CODEC, "B"))
+REQUEST_FIELDS = [struct.Struct("!" + "".join(code for flag, code in _FIELDS if flags & flag))
+                  for flags in range(1 << len(_FIELDS))] # one precompiled layout per flags value
+OPCODES = {"LIST": 1, "LISTX": 2, "GET": 3, "PUT": 4, "DPUT": 5, "MGET": 6, "CODECS": 7, "STATS": 8,
+           "RESUME": 9, "SUMS": 10, "GET-IF-NONE-MATCH": 11, "MANIFEST": 12}
+COMMANDS = {opcode: command for command, opcode in OPCODES.items()}
+CODEC_NAMES = {codec_id: name for name, (codec_id, compress, decompress) in CODECS.items()}
+TEXT_ARGS = {"GET": (1, 3), "PUT": (1, 2), "DPUT": (1,), "RESUME": (1,), "SUMS": (1, 2),
+             "GET-IF-NONE-MATCH": (2,), "MANIFEST": (0, 1)} # argument counts in text form
+MIN_NAMES = dict({command: counts[0] for command, counts in TEXT_ARGS.items()}, MGET=1) # in binary form
+PATH_NAMES = dict({command: 1 for command in TEXT_ARGS}, MGET=None) # leading names that are paths, None for all
+
+def safe_path(name): # a relative path that stays inside the store: not absolute, no "..", no empty or "." parts
+    return bool(name) and "\0" not in name and all(part not in ("", ".", "..") for part in name.split("/"))
+
+def _paths_ok(request):
+    if request.command not in PATH_NAMES:
+        return True
+    return all(safe_path(name) for name in request.names[:PATH_NAMES[request.command]])
+
+def _checked(request): # request, or a malformed one if a name would leave the store
+    if _paths_ok(request):
+        return request
+    if request.command in ("PUT", "DPUT"): # a body follows: the handler reads it, then sends refused
+        request.refused = b"ERROR: Bad path"
+        return request
+    return Request("", tag=request.tag)
+
+class Request:
+    # names: file names (or LISTX options, CODECS codec names); offset: GET range start or PUT resume
+    # point; length: GET range length, SUMS count or LISTX limit. A text number that isn't one is -1,
+    # for the handler to refuse. codec: False to use the connection's (see CODECS), else a name or None.
+    # refused: the reply for a PUT or DPUT whose name was refused, once its body has been read; else None
+    __slots__ = ("command", "names", "tag", "offset", "length", "codec", "refused")
+    def __init__(self, command, names=(), tag=None, offset=None, length=None, codec=False):
+        self.command, self.names, self.tag = command, list(names), tag
+        self.offset, self.length, self.codec = offset, length, codec
+        self.refused = None
+
+    @property
+    def name(self):
+        return self.names[0]
+
+def _number(text):
+    return int(text) if text.isdigit() else -1
+
+def encode_request(command, names=(), tag=None, offset=None, length=None, codec=False): # a binary request frame's payload
+    flags, fields = 0, []
+    if tag is not None:
+        flags |= REQ_TAG
+        fields.append(tag)
+    if offset is not None:
+        flags |= REQ_OFFSET
+        fields.append(offset)
+    if length is not None:
+        flags |= REQ_LENGTH
+        fields.append(length)
+    if codec is not False:
+        flags |= REQ_CODEC
+        fields.append(CODECS[codec][0] if codec else 0)
+    path = "\0".join(names).encode(errors="surrogateescape")
+    return REQUEST_HEADER.pack(REQUEST_V1, OPCODES[command], flags, len(path)) + REQUEST_FIELDS[flags].pack(*fields) + path
+
+def text_request(command, names=(), tag=None, offset=None, length=None): # the same request as a text command
+    parts = [f"@{tag}"] if tag is not None else []
+    parts.append(command)
+    parts.extend(names)
+    parts.extend(str(n) for n in (offset, length) if n is not None)
+    return " ".join(parts).encode()
+
+def parse_request(data): # Request from a request frame, None if it is blank; a malformed one has command ""
+    if data[:1] == b"\xf1":
+        if len(data) < REQUEST_HEADER.size:
+            return Request("")
+        version, opcode, flags, path_length = REQUEST_HEADER.unpack_from(data)
+        layout = REQUEST_FIELDS[flags & 15]
+        start = REQUEST_HEADER.size + layout.size
+        command = COMMANDS.get(opcode)
+        if command is None or flags > 15 or len(data) != start + path_length:
+            return Request("")
+        values = layout.unpack_from(data, REQUEST_HEADER.size)
+        request = Request(command, bytes(data[start:]).decode(errors="surrogateescape").split("\0") if path_length else ())
+        if flags:
+            values = iter(values)
+            if flags & REQ_TAG: request.tag = str(next(values))
+            if flags & REQ_OFFSET: request.offset = next(values)
+            if flags & REQ_LENGTH: request.length = next(values)
+            if flags & REQ_CODEC: request.codec = CODEC_NAMES.get(next(values)) # one we lack: raw is always readable
+        if len(request.names) < MIN_NAMES.get(command, 0) \
+                or command == "GET" and (request.offset is None) != (request.length is None):
+            return Request("", tag=request.tag)
+        if command == "LISTX": # the same options a text LISTX spells out
+            after, glob = (request.names + ["", ""])[:2]
+            request.names = [f"{key}={value}" for key, value in (("after", after), ("glob", glob)) if value]
+            if request.length is not None:
+                request.names.append(f"limit={request.length}")
+        return _checked(request)
+    parts = data.decode(errors="replace").split()
+    if not parts:
+        return None
+    tag = None
+    if parts[0].startswith("@"): # tagged request: the tag is echoed ahead of the reply
+        tag, parts = parts[0][1:], parts[1:] or [""]
+    command, args = parts[0], parts[1:]
+    counts = TEXT_ARGS.get(command)
+    if counts is not None and len(args) not in counts or command == "MGET" and not args:
+        return Request("", tag=tag)
+    request = Request(command, args, tag)
+    if command == "GET" and len(args) == 3:
+        request.names, request.offset, request.length = args[:1], _number(args[1]), _number(args[2])
+    elif command == "PUT" and len(args) == 2:
+        request.names, request.offset = args[:1], _number(args[1])
+    elif command == "SUMS" and len(args) == 2:
+        request.names, request.length = args[:1], _number(args[1])
+    return _checked(request) # a name that would leave the store is refused before any handler sees it
+
+# ---- sans-IO decoder ----
+
+FRAME, CHUNK, END = "frame", "chunk", "end" # event kinds returned by next_event
+
+# decoder states
+_FRAME_LEN, _FRAME_BODY, _STREAM_TOTAL, _CHUNK_LEN, _CHUNK_BODY = range(5)
+
+class FrameDecoder: # feed() received bytes, then call next_event() until it returns None
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buf = bytearray()
+        self.max_frame = max_frame
+        self.state, self.need = _FRAME_LEN, FRAME_HEADER.size
+        self.total = self.received = 0
+
+    def feed(self, data):
+        self.buf += data
+
+    def buffered(self): # bytes received but not yet returned as events
+        return len(self.buf)
+
+    def streaming(self): # inside a stream started with start_stream()
+        return self.state in (_STREAM_TOTAL, _CHUNK_LEN, _CHUNK_BODY)
+
+    def start_stream(self): # the next bytes are a stream rather than a frame
+        if self.state != _FRAME_LEN:
+            raise FramingError("stream can only start between frames")
+        self.state, self.need = _STREAM_TOTAL, STREAM_HEADER.size
+
+    def _take(self, n):
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def next_event(self): # (FRAME, bytes), (CHUNK, bytes), (END, ok) or None if more input is needed
+        buf = self.buf
+        while True:
+            state = self.state
+            if state == _CHUNK_BODY: # hand body bytes out as they arrive, never buffer a whole chunk
+                n = min(len(buf), self.need)
+                if n == 0:
+                    return None
+                self.need -= n
+                self.received += n
+                if self.need == 0:
+                    self.state, self.need = _CHUNK_LEN, FRAME_HEADER.size
+                return CHUNK, self._take(n)
+            if len(buf) < self.need:
+                return None
+            if state == _FRAME_LEN:
+                length = FRAME_HEADER.unpack(self._take(self.need))[0]
+                if length > self.max_frame:
+                    raise FramingError("frame of %d bytes is too large" % length)
+                self.state, self.need = _FRAME_BODY, length
+            elif state == _FRAME_BODY:
+                data = self._take(self.need)
+                self.state, self.need = _FRAME_LEN, FRAME_HEADER.size
+                return FRAME, data
+            elif state == _STREAM_TOTAL:
+                self.total = STREAM_HEADER.unpack(self._take(self.need))[0]
+                self.received = 0
+                self.state, self.need = _CHUNK_LEN, FRAME_HEADER.size
+            elif state == _CHUNK_LEN:
+                length = FRAME_HEADER.unpack(self._take(self.need))[0]
+                if length == 0: # end of stream, back to plain frames
+                    self.state = _FRAME_LEN
+                    return END, self.received == self.total
+                if length > CHUNK_SIZE:
+                    raise FramingError("chunk of %d bytes is too large" % length)
+                self.state, self.need = _CHUNK_BODY, length
+
+# ---- blocking sockets ----
+
+# accurately reconstruct complete messages regardless of how they're fragmented
+def send_framed(sock, data: bytes):
+    sock.sendall(frame(data)) # tells receiver exactly how many bytes to expect
+
+def recv_into_all(sock, view): # fills view completely, False if the peer closed first
+    pos, n = 0, len(view)
+    while pos < n:
+        got = sock.recv_into(view[pos:]) # kernel copies straight into our buffer, nothing allocated
+        if not got:
+            return False
+        pos += got
+    return True
+
+def recv_all(sock, n): #collects all the pieces until it has the complete message
+    data = bytearray(n) # one buffer of the final size, filled in place
+    if not recv_into_all(sock, memoryview(data)):
+        return None
+    return data
+
+def recv_framed(sock): # receives the length header and then the message
+    length_data = recv_all(sock, FRAME_HEADER.size) #first reading the 4-byte length header
+    if not length_data:
+        return None
+    length = FRAME_HEADER.unpack(length_data)[0] #uses length to read the exact # of bytes message
+    if length > MAX_FRAME: # don't preallocate whatever a confused peer asks for
+        return None
+    return recv_all(sock, length)
+
+def encode_stream(data, codec=None): # a whole stream for a small body, ready to append to an output batch
+    out = [stream_header(len(data))]
+    for offset in range(0, len(data), CHUNK_SIZE):
+        out.append(encode_chunk(data[offset:offset + CHUNK_SIZE], codec))
+    out.append(END_OF_STREAM)
+    return b"".join(out)
+
+class _MappedWindow: # forgets the pages of a mapping once a transfer has moved past them, so RSS stays flat
+    def __init__(self, m, pos):
+        self.m, self.done = m, pos - pos % mmap.PAGESIZE
+    def advance(self, pos):
+        pos -= pos % mmap.PAGESIZE
+        if pos > self.done and hasattr(mmap, "MADV_DONTNEED"): # shared file pages stay in the page cache
+            self.m.madvise(mmap.MADV_DONTNEED, self.done, pos - self.done)
+            self.done = pos
+
+def _send_mapped(sock, f, total, codec): # send_stream body as memoryview slices of a read-only mapping
+    offset = f.tell()
+    end = min(offset + total, os.fstat(f.fileno()).st_size) # a file that shrank is sent short, as read() would
+    if end > offset: # (truncating it during the send would raise SIGBUS; uploads replace files by rename)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+            m.madvise(mmap.MADV_SEQUENTIAL)
+            window = _MappedWindow(m, offset)
+            for pos in range(offset, end, CHUNK_SIZE):
+                with view[pos:min(pos + CHUNK_SIZE, end)] as chunk:
+                    if codec is not None:
+                        sock.sendall(encode_chunk(chunk, codec))
+                    else: # the slice goes to the socket as is, no bytes object in between
+                        sock.sendall(chunk_header(len(chunk)))
+                        sock.sendall(chunk)
+                window.advance(pos + CHUNK_SIZE)
+    f.seek(end)
+    sock.sendall(END_OF_STREAM)
+
+def send_stream(sock, f, total, use_sendfile=USE_SENDFILE, codec=None, use_mmap=False): # sends total bytes of f as chunk frames
+    sock.sendall(stream_header(total)) # 8-byte header so files over 4 GiB fit
+    if use_mmap and total >= MMAP_THRESHOLD:
+        return _send_mapped(sock, f, total, codec)
+    remaining = total
+    offset = f.tell()
+    while remaining > 0:
+        if codec is not None: # compression needs the bytes in user space, so no sendfile
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sock.sendall(encode_chunk(chunk, codec))
+            length = len(chunk)
+        elif use_sendfile: # header from user space, body never leaves the kernel
+            length = min(CHUNK_SIZE, remaining)
+            sock.sendall(chunk_header(length))
+            sent = sock.sendfile(f, offset, length)
+            if sent < length: # file shrank after the frame header went out
+                raise ConnectionError("file truncated during sendfile")
+            offset += sent
+        else:
+            chunk = f.read(min(CHUNK_SIZE, remaining)) # only one chunk is ever held in memory
+            if not chunk:
+                break # file shrank while sending, receiver will see the short count
+            sock.sendall(chunk_header(len(chunk)) + chunk)
+            length = len(chunk)
+        remaining -= length
+    sock.sendall(END_OF_STREAM)
+
+def _recv_mapped(sock, f, total, header, digest): # recv_stream body: chunks land straight in a mapping of f
+    start = f.tell()
+    try:
+        f.truncate(start + total) # preallocate the declared length so it can be mapped
+        m = mmap.mmap(f.fileno(), start + total) # f must be open for reading and writing
+    except (OSError, ValueError, OverflowError):
+        return None
+    received, value = 0, None
+    with m, memoryview(m) as view:
+        window = _MappedWindow(m, start)
+        try:
+            while True:
+                if not recv_into_all(sock, header):
+                    break
+                value = FRAME_HEADER.unpack(header)[0]
+                if value == 0: # end of stream
+                    break
+                codec_id, length = value >> CODEC_SHIFT, value & LENGTH_MASK
+                if length > CHUNK_SIZE:
+                    break
+                pos = start + received
+                if codec_id:
+                    payload = recv_all(sock, length)
+                    data = decode_chunk(codec_id, payload) if payload is not None else None
+                    if data is None or received + len(data) > total:
+                        break
+                    view[pos:pos + len(data)] = data
+                    received += len(data)
+                else:
+                    if received + length > total or not recv_into_all(sock, view[pos:pos + length]):
+                        break
+                    received += length
+                if digest is not None:
+                    digest.update(view[pos:start + received])
+                window.advance(start + received)
+        except (OSError, FramingError): # handled like a peer that hung up, after the mapping is closed
+            value = None
+    if received != total: # keep only what really arrived, so a resume starts in the right place
+        f.truncate(start + received)
+    f.seek(start + received)
+    return received if received == total and value == 0 else None
+
+def recv_stream(sock, f, buf=None, use_mmap=False, digest=None): # writes chunk frames to f until the end marker, returns byte count
+    # digest: a hashlib object fed the body as it arrives, so it costs no second pass over the file
+    header = memoryview(bytearray(STREAM_HEADER.size))
+    if not recv_into_all(sock, header):
+        return None
+    total = STREAM_HEADER.unpack(header)[0]
+    header = header[:FRAME_HEADER.size]
+    if use_mmap and total >= MMAP_THRESHOLD:
+        return _recv_mapped(sock, f, total, header, digest)
+    if buf is None:
+        buf = bytearray(CHUNK_SIZE) # reused for every chunk; pass one in to reuse it across transfers
+    view = memoryview(buf)
+    received = 0
+    while True:
+        if not recv_into_all(sock, header):
+            return None
+        value = FRAME_HEADER.unpack(header)[0]
+        if value == 0: # end of stream
+            break
+        codec_id, length = value >> CODEC_SHIFT, value & LENGTH_MASK
+        if length > CHUNK_SIZE: # refuse a chunk larger than the buffer
+            return None
+        if not recv_into_all(sock, view[:length]):
+            return None
+        if codec_id:
+            try:
+                data = decode_chunk(codec_id, view[:length])
+            except FramingError:
+                return None
+            f.write(data)
+            received += len(data)
+            if digest is not None:
+                digest.update(data)
+            continue
+        f.write(view[:length]) # straight from the receive buffer to the file
+        received += length
+        if digest is not None:
+            digest.update(view[:length])
+    if received != total: # sender stopped short or sent too much
+        return None
+    return received
+
+# ---- asyncio streams ----
+
+async def read_exactly(reader, n): # like recv_all: None if the peer closed early
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError:
+        return None
+
+async def read_frame(reader):
+    length_data = await read_exactly(reader, FRAME_HEADER.size)
+    if not length_data:
+        return None
+    length = FRAME_HEADER.unpack(length_data)[0]
+    if length > MAX_FRAME:
+        raise FramingError("frame of %d bytes is too large" % length)
+    return await read_exactly(reader, length)
+
+async def write_frame(writer, data: bytes): # waits for the transport to drain
+    writer.write(frame(data))
+    await writer.drain()
+
+def _store_chunk(f, chunk, digest): # read_stream's file work, on an executor thread when it has one
+    f.write(chunk)
+    if digest is not None:
+        digest.update(chunk)
+
+async def write_stream(writer, f, total, executor=None): # f is a blocking file; reads are one chunk at a time
+    # executor: a concurrent.futures executor to run the reads on, instead of the event loop
+    loop = asyncio.get_running_loop()
+    writer.write(stream_header(total))
+    remaining = total
+    while remaining > 0:
+        n = min(CHUNK_SIZE, remaining)
+        chunk = f.read(n) if executor is None else await loop.run_in_executor(executor, f.read, n)
+        if not chunk:
+            break
+        writer.write(chunk_header(len(chunk)))
+        writer.write(chunk)
+        remaining -= len(chunk)
+        await writer.drain() # backpressure: at most about one chunk queued per stream
+    writer.write(END_OF_STREAM)
+    await writer.drain()
+
+async def read_stream(reader, f, digest=None, executor=None): # same result as recv_stream; executor as in write_stream
+    loop = asyncio.get_running_loop()
+    total_data = await read_exactly(reader, STREAM_HEADER.size)
+    if not total_data:
+        return None
+    total = STREAM_HEADER.unpack(total_data)[0]
+    received = 0
+    while True:
+        length_data = await read_exactly(reader, FRAME_HEADER.size)
+        if not length_data:
+            return None
+        length = FRAME_HEADER.unpack(length_data)[0]
+        if length == 0:
+            break
+        if length > CHUNK_SIZE:
+            return None
+        chunk = await read_exactly(reader, length)
+        if chunk is None:
+            return None
+        if executor is None:
+            _store_chunk(f, chunk, digest)
+        else:
+            await loop.run_in_executor(executor, _store_chunk, f, chunk, digest)
+        received += length
+    if received != total:
+        return None
+    return received
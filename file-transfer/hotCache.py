@@ -0,0 +1,102 @@
+# In-memory cache of whole GET replies for small, frequently fetched files.
+#
+# An entry is the exact bytes a GET of the file sends (the OK frame and the
+# encoded stream) for one codec, so a hit costs no open, read or compression,
+# just one sendall. Entries are checked against the file's size, mtime and
+# inode on every lookup, dropped by fileStore's commit hook when an upload
+# replaces the file, and evicted least recently used first once the cached
+# bytes exceed the budget.
+
+import os
+import threading
+from collections import OrderedDict
+from framing import frame, encode_stream, choose_codec
+import fileStore
+
+CACHE_BUDGET = 256 * 1024 * 1024   # bytes of cached replies
+MAX_CACHED_FILE = 4 * 1024 * 1024  # bigger files always go through sendfile
+
+class HotCache:
+    def __init__(self, budget=CACHE_BUDGET, max_file=MAX_CACHED_FILE):
+        self.budget, self.max_file = budget, max_file
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # (name, codec) -> (identity, reply); least recently used first
+        self.used = 0                   # bytes of replies held
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.bypasses = 0               # GETs of files too big to cache, kept out of the misses
+
+    def lookup(self, key, st): # cached reply for key if the file is unchanged, else None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fileStore.identity(st):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None: # the file changed behind our back
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def store(self, key, st, reply):
+        if len(reply) > self.budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (fileStore.identity(st), reply)
+            self.used += len(reply)
+            while self.used > self.budget:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def bypass(self, key): # key's file is over max_file, so it is never looked up
+        with self.lock:
+            self.bypasses += 1
+            if key in self.entries: # it grew behind our back
+                self._remove(key)
+                self.invalidations += 1
+
+    def _remove(self, key): # caller holds the lock
+        self.used -= len(self.entries.pop(key)[1])
+
+    def invalidate(self, name): # an upload just replaced name
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == name]:
+                self._remove(key)
+                self.invalidations += 1
+
+    def counters(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "invalidations": self.invalidations, "bypasses": self.bypasses,
+                    "files": len(self.entries), "bytes": self.used}
+
+cache = HotCache()
+fileStore.commit_hooks.append(lambda name, dir_mtime_ns: cache.invalidate(name))
+
+def cached_reply(name, codec=None): # GET reply for name from the cache, filling it on a miss; None if not cacheable
+    path = fileStore.file_path(name)
+    try:
+        st = os.stat(path)
+        if st.st_size > cache.max_file:
+            cache.bypass((name, codec))
+            return None
+        reply = cache.lookup((name, codec), st)
+        if reply is not None:
+            return reply
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno()) # describe what we actually read
+            if st.st_size > cache.max_file: # grew since the stat
+                return None
+            file_codec = choose_codec(path, f, codec) # samples from the current position, so before the read
+            data = f.read(st.st_size)
+        fileStore.file_digest(name, st, data=data) # known from now on if it wasn't, without another read
+        reply = frame(fileStore.get_status(name, st)) + encode_stream(data, file_codec)
+    except OSError:
+        return None # let the uncached path report it
+    cache.store((name, codec), st, reply)
+    return reply
+
+def stats_reply(): # STATS: the counters as "OK key=value ..."
+    return ("OK " + " ".join(f"{key}={value}" for key, value in cache.counters().items())).encode()
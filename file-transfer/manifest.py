@@ -0,0 +1,80 @@
+# Tree manifests for MANIFEST and tree sync (treeSync.py).
+#
+# A manifest lists every regular file under a directory with its size, mtime
+# and SHA-256. Entries are sorted by path and each path is stored as the
+# number of bytes it shares with the previous one plus the rest, so a deep
+# tree costs little more than its leaf names: 52 bytes a file plus the part
+# of its path that differs from the one before. The server sends one as a
+# stream, which compresses further when the client negotiated a codec.
+# Symlinks are skipped on both sides, so a sync never follows one out of the
+# tree.
+
+import os
+import struct
+from framing import frame, encode_stream, safe_path
+import fileStore
+
+ENTRY = struct.Struct("!HHQq32s")   # bytes shared with the previous path, bytes that follow, size, mtime_ns, SHA-256
+NO_DIGEST = bytes(32)               # a file whose digest isn't known
+
+def scan(root): # yields (relative path, stat) for every regular file under root, "/"-separated, in no set order
+    pending = [""]
+    while pending:
+        rel = pending.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel) if rel else root)
+        except OSError: # vanished or unreadable: skipped like a file that went away
+            continue
+        with it:
+            for entry in it:
+                path = f"{rel}/{entry.name}" if rel else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield path, entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+def encode(entries): # entries: (path, size, mtime_ns, hex digest or None), any order
+    out, previous = [], b""
+    for path, size, mtime_ns, hexdigest in sorted(entries):
+        encoded = path.encode(errors="surrogateescape")
+        shared = 0
+        limit = min(len(encoded), len(previous), 0xFFFF)
+        while shared < limit and encoded[shared] == previous[shared]:
+            shared += 1
+        out.append(ENTRY.pack(shared, len(encoded) - shared, size, mtime_ns,
+                              bytes.fromhex(hexdigest) if hexdigest else NO_DIGEST))
+        out.append(encoded[shared:])
+        previous = encoded
+    return b"".join(out)
+
+def decode(data): # {path: (size, mtime_ns, hex digest or None)}; ValueError if data isn't a manifest
+    entries, previous = {}, b""
+    view, pos = memoryview(data), 0
+    try:
+        while pos < len(view):
+            shared, rest, size, mtime_ns, digest = ENTRY.unpack_from(view, pos)
+            pos += ENTRY.size
+            if shared > len(previous) or pos + rest > len(view):
+                raise ValueError("truncated manifest")
+            encoded = previous[:shared] + bytes(view[pos:pos + rest])
+            pos += rest
+            entries[encoded.decode(errors="surrogateescape")] = (size, mtime_ns, digest.hex() if digest != NO_DIGEST else None)
+            previous = encoded
+    except struct.error:
+        raise ValueError("truncated manifest")
+    return entries
+
+def manifest_reply(prefix="", codec=None): # MANIFEST [<dir>]: "OK <n>" then the manifest of the tree under dir as a stream
+    if prefix and not safe_path(prefix):
+        return frame(b"ERROR: Bad path")
+    root = fileStore.file_path(prefix) if prefix else fileStore.SERVER_FILES_DIR
+    if not os.path.isdir(root):
+        return frame(b"ERROR: No such directory")
+    entries = []
+    for path, st in scan(root): # sidecars make this a stat and a lookup per file; files without one are hashed once
+        hexdigest = fileStore.file_digest(f"{prefix}/{path}" if prefix else path, st)
+        entries.append((path, st.st_size, st.st_mtime_ns, hexdigest))
+    return frame(f"OK {len(entries)}".encode()) + encode_stream(encode(entries), codec)
@@ -0,0 +1,224 @@
+# Server instrumentation: counters, gauges and histograms rendered in the
+# Prometheus text exposition format, served from a small HTTP thread at
+# /metrics and optionally summarized to stdout every few seconds.
+#
+# A Meter wraps one connection's socket, and the files its requests touch, so
+# the handlers keep calling send_stream/recv_stream unchanged while bytes and
+# time are charged to the request in progress. Each request's time is split
+# into phases: queue (command received, handler not started yet), network
+# (inside socket calls, sendfile included), disk (file reads, writes and
+# commits) and the rest, which is our own cpu. Updates take one short lock,
+# cheap next to the 1 MiB chunks they account for.
+
+import threading
+import time
+import bisect
+import contextlib
+import http.server
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_metrics = []           # every metric, in the order they were created
+collectors = []         # functions returning extra exposition lines, e.g. cache counters
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}        # label values tuple -> number
+        _metrics.append(self)
+    def inc(self, amount=1, *labels):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+    def total(self):
+        with _lock:
+            return sum(self.values.values())
+    def render(self):
+        return [f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    kind = "gauge"
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+class Histogram:
+    kind = "histogram"
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames, self.buckets = name, help, labelnames, buckets
+        self.values = {}        # label values tuple -> [count per bucket (+Inf last), sum]
+        _metrics.append(self)
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+    def render(self):
+        lines = []
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+connections_active = Gauge("ft_connections_active", "Client connections currently open")
+connections_total = Counter("ft_connections_total", "Client connections accepted")
+requests_total = Counter("ft_requests_total", "Requests handled", ("command",))
+bytes_received = Counter("ft_bytes_received_total", "Bytes read from clients, command frames included", ("command",))
+bytes_sent = Counter("ft_bytes_sent_total", "Bytes sent to clients", ("command",))
+errors_total = Counter("ft_errors_total", "Failed requests and connections by type", ("type",))
+request_seconds = Histogram("ft_request_seconds", "Whole request time", ("command",))
+phase_seconds = Histogram("ft_request_phase_seconds", "Request time spent per phase", ("command", "phase"))
+
+def error(kind):
+    errors_total.inc(1, kind)
+
+def render(): # the whole exposition, as text
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+    for collect in collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+class MeteredSocket: # a socket whose traffic and time are charged to a Meter
+    def __init__(self, sock, meter):
+        self._sock, self._meter = sock, meter
+    def __getattr__(self, name): # setsockopt, close, fileno ... pass straight through
+        return getattr(self._sock, name)
+    def recv_into(self, buffer, nbytes=0):
+        start = time.perf_counter()
+        n = self._sock.recv_into(buffer, nbytes)
+        self._meter.arrived = time.perf_counter()
+        self._meter.network += self._meter.arrived - start
+        self._meter.received += n
+        return n
+    def recv(self, bufsize):
+        start = time.perf_counter()
+        data = self._sock.recv(bufsize)
+        self._meter.arrived = time.perf_counter()
+        self._meter.network += self._meter.arrived - start
+        self._meter.received += len(data)
+        return data
+    def sendall(self, data):
+        start = time.perf_counter()
+        self._sock.sendall(data)
+        self._meter.network += time.perf_counter() - start
+        self._meter.sent += len(data) if not isinstance(data, memoryview) else data.nbytes
+    def sendfile(self, file, offset=0, count=None): # disk reads happen inside the kernel copy; counted as network
+        start = time.perf_counter()
+        sent = self._sock.sendfile(getattr(file, "_file", file), offset, count)
+        self._meter.network += time.perf_counter() - start
+        self._meter.sent += sent
+        return sent
+
+class MeteredFile: # a file whose reads and writes are charged to a Meter as disk time
+    def __init__(self, file, meter):
+        self._file, self._meter = file, meter
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self._file.close()
+    def read(self, *args):
+        start = time.perf_counter()
+        data = self._file.read(*args)
+        self._meter.disk += time.perf_counter() - start
+        return data
+    def write(self, data):
+        start = time.perf_counter()
+        n = self._file.write(data)
+        self._meter.disk += time.perf_counter() - start
+        return n
+
+class Meter: # per connection: wraps its socket and files and records each request's bytes and phases
+    def __init__(self, sock):
+        self.sock = MeteredSocket(sock, self)
+        self.received = self.sent = 0
+        self.network = self.disk = 0.0
+        self.started = self.arrived = None # arrived: when the last recv on the socket returned
+        connections_total.inc()
+        connections_active.inc()
+
+    def file(self, f):
+        return MeteredFile(f, self)
+
+    @contextlib.contextmanager
+    def disk_time(self): # charge a block (open, fsync and rename ...) to disk
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.disk += time.perf_counter() - start
+
+    def begin(self): # the command frame just read starts a request
+        self.started = time.perf_counter()
+        self.queued = self.started - self.arrived
+        self.network = self.disk = 0.0 # waiting for the command was idle time, not this request's
+
+    def end(self, command):
+        elapsed = time.perf_counter() - self.started
+        requests_total.inc(1, command)
+        bytes_received.inc(self.received, command)
+        bytes_sent.inc(self.sent, command)
+        request_seconds.observe(self.queued + elapsed, command)
+        phase_seconds.observe(self.queued, command, "queue")
+        phase_seconds.observe(self.network, command, "network")
+        phase_seconds.observe(self.disk, command, "disk")
+        phase_seconds.observe(max(0.0, elapsed - self.network - self.disk), command, "cpu")
+        self.received = self.sent = 0
+        self.started = None
+
+    def close(self):
+        connections_active.dec()
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args): # scrapes would drown out the server's own log
+        pass
+
+def serve(port, host="127.0.0.1"): # /metrics on a daemon thread; returns the HTTP server
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def log_every(interval): # prints a one-line summary every interval seconds on a daemon thread
+    def loop():
+        last = (time.monotonic(), requests_total.total(), bytes_received.total(), bytes_sent.total())
+        while True:
+            time.sleep(interval)
+            now = (time.monotonic(), requests_total.total(), bytes_received.total(), bytes_sent.total())
+            seconds = now[0] - last[0]
+            print(f"[stats] {connections_active.get():.0f} connections  {(now[1] - last[1]) / seconds:.1f} req/s  "
+                  f"in {(now[2] - last[2]) / seconds / (1 << 20):.2f} MB/s  out {(now[3] - last[3]) / seconds / (1 << 20):.2f} MB/s  "
+                  f"errors {errors_total.total():.0f}")
+            last = now
+    threading.Thread(target=loop, daemon=True).start()
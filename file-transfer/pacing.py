@@ -0,0 +1,132 @@
+# Bandwidth shaping and fair scheduling of the servers' sends.
+#
+# Every send is cut into QUANTUM-sized pieces, and each piece first takes
+# tokens from its client's bucket (one per client address, shared by all of
+# that client's connections) and then from the global bucket. The global
+# bucket hands out its tokens in start-time fair queueing order rather than
+# first come first served: each connection's next piece is tagged with
+# max(virtual time, the end tag of its previous piece) and tags grow by
+# size / weight, so a connection that has just started competes at the
+# current virtual time instead of queueing behind a bulk download's backlog.
+# This is the pacing stammerProxy does with delaySendUntil, done with real
+# rates and for many senders at once.
+
+import heapq
+import itertools
+import threading
+import time
+
+QUANTUM = 64 * 1024     # bytes sent per scheduling decision
+BURST_SECONDS = 0.05    # a bucket holds this much of its rate, at least one QUANTUM
+
+class TokenBucket: # rate bytes/s; may go into debt by one send so a send bigger than the burst still passes
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(QUANTUM, rate * BURST_SECONDS)
+        self.tokens, self.stamp = self.burst, time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self, n): # seconds until n bytes may go; caller holds the lock
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = min(n, self.burst)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def wait(self, n): # block until n bytes may go, then take them
+        while True:
+            with self.lock:
+                pause = self.delay(n)
+                if pause == 0.0:
+                    self.tokens -= n
+                    return
+            time.sleep(pause)
+
+class FairScheduler: # the global bucket, granted in start-time fair queueing order
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate)
+        self.cond = threading.Condition(self.bucket.lock)
+        self.waiting = []       # heap of (start tag, seq)
+        self.seq = itertools.count()
+        self.vtime = 0.0        # start tag of the piece served last
+
+    def wait(self, flow, n):
+        with self.cond:
+            start = max(self.vtime, flow.finish)
+            flow.finish = start + n / flow.weight
+            entry = (start, next(self.seq))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                if self.waiting[0] == entry: # our turn: wait only for the tokens
+                    pause = self.bucket.delay(n)
+                    if pause == 0.0:
+                        self.bucket.tokens -= n
+                        heapq.heappop(self.waiting)
+                        self.vtime = start
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait(pause)
+                else:
+                    self.cond.wait()
+
+class Flow: # one connection's place in the schedule
+    def __init__(self, client, weight):
+        self.client, self.weight, self.finish = client, weight, 0.0
+
+class PacedSocket: # a socket whose sends are split into quanta and paced by a Pacer
+    def __init__(self, sock, pacer, flow):
+        self._sock, self._pacer, self._flow = sock, pacer, flow
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        for pos in range(0, len(view), QUANTUM):
+            piece = view[pos:pos + QUANTUM]
+            self._pacer.wait(self._flow, len(piece))
+            self._sock.sendall(piece)
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        while count is None or sent < count:
+            n = QUANTUM if count is None else min(QUANTUM, count - sent)
+            self._pacer.wait(self._flow, n)
+            got = self._sock.sendfile(file, offset + sent, n)
+            if not got:
+                break
+            sent += got
+        return sent
+
+class Pacer: # server-wide limits; rates in bytes/s, 0 for unlimited
+    def __init__(self, global_rate=0, client_rate=0, weights=None):
+        self.scheduler = FairScheduler(global_rate) if global_rate else None
+        self.client_rate = client_rate
+        self.weights = weights or {}    # client address -> share of the global rate, default 1
+        self.clients = {}               # client address -> [bucket, connections using it]
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.scheduler is not None or bool(self.client_rate)
+
+    def socket(self, sock, addr): # wrap a new connection's socket; release(addr) when it closes
+        client = None
+        if self.client_rate:
+            with self.lock:
+                entry = self.clients.setdefault(addr[0], [None, 0])
+                if entry[0] is None:
+                    entry[0] = TokenBucket(self.client_rate)
+                entry[1] += 1
+                client = entry[0]
+        return PacedSocket(sock, self, Flow(client, self.weights.get(addr[0], 1)))
+
+    def release(self, addr):
+        if self.client_rate:
+            with self.lock:
+                entry = self.clients[addr[0]]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.clients[addr[0]]
+
+    def wait(self, flow, n):
+        if flow.client is not None:
+            flow.client.wait(n)
+        if self.scheduler is not None:
+            self.scheduler.wait(flow, n)
@@ -0,0 +1,68 @@
+# Prefork supervisor shared by the servers.
+#
+# The supervisor forks a fixed number of workers, each running a whole
+# server loop in its own process (and so under its own GIL). Either they all
+# accept from one listening socket opened before the fork, or each binds its
+# own with SO_REUSEPORT and the kernel spreads new connections across them.
+# Like fork-demo/helloServer.py, the supervisor reaps exited children with
+# os.waitid, and it forks a replacement for each one that dies.
+
+import os, signal, socket, sys, time, traceback
+
+RESPAWN_DELAY = 1.0     # seconds; a worker dying sooner than this after it started is replaced only after a pause
+
+def listen(bindaddr, reuseport=False): # a listening TCP socket
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport: # several sockets on one port, the kernel balances connections between them
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind(bindaddr)
+    lsock.listen(socket.SOMAXCONN)
+    return lsock
+
+def spawn(run): # fork a worker running run(); returns its pid
+    pid = os.fork()
+    if pid == 0: # child: never returns into the supervisor's code
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run()
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc(file=sys.stdout)
+            status = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+    return pid
+
+def supervise(workers, run): # keep workers copies of run() going until interrupted
+    started = {}                # pid -> time.monotonic() when it was forked
+    for i in range(workers):
+        started[spawn(run)] = time.monotonic()
+    print(f"[*] Supervisor {os.getpid()} started {workers} workers: {sorted(started)}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            waitResult = os.waitid(os.P_ALL, 0, os.WEXITED) # blocks until some worker exits
+            pid, status = waitResult.si_pid, waitResult.si_status
+            if pid not in started:
+                continue
+            print(f"[-] Worker {pid} exited with status {status}, respawning")
+            if time.monotonic() - started.pop(pid) < RESPAWN_DELAY: # don't spin on a worker that can't start
+                time.sleep(RESPAWN_DELAY)
+            started[spawn(run)] = time.monotonic()
+    except KeyboardInterrupt:
+        print("[-] Supervisor interrupted, stopping workers")
+    finally: # interrupted or terminated: take the workers down too
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in started:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 import sys
 import traceback
-from select import *
+import selectors
+from selectors import EVENT_READ, EVENT_WRITE
 from socket import *
 import time
+import heapq
+import itertools
+from collections import deque
+import resource
 import random #Imports necessary modules for networking, error handling, and random behavior
 
 import re
@@ -16,7 +21,17 @@ switchesVarDefaults = ( #Defines command-line parameters with their default valu
     (('-s', '--server'), 'server', "127.0.0.1:50001"),
     (('-d', '--debug'), "debug", False), # boolean (set if present)
     (('-?', '--usage'), "usage", False), # boolean (set if present)
-    (('-p', '--pausedelay'), 'pauseDelay', 0.5)
+    (('-p', '--pausedelay'), 'pauseDelay', 0.5),
+    (('-m', '--mode'), 'mode', "stammer"), # impairment profile, one of PROFILES
+    (('-S', '--seed'), 'seed', "random"), # seeds every random choice, so a run can be replayed
+    (('-t', '--latency'), 'latency', "profile"), # one-way ms; this and the next four override the profile
+    (('-j', '--jitter'), 'jitter', "profile"), # +/- ms on each read's latency
+    (('-r', '--rate'), 'rate', "profile"), # bytes/s per direction, 0 for unlimited
+    (('-c', '--chunk'), 'chunk', "profile"), # bytes per send, like a packet; 0 sends all that is due
+    (('-x', '--stall'), 'stall', "profile"), # chance:seconds, a send stalls the stream with that chance
+    (('-b', '--bufcap'), 'bufCap', "profile"), # bytes buffered per direction
+    (('-H', '--highwater'), 'highWater', 1.0), # stop reading once the buffer is this full (fraction of bufCap)
+    (('-L', '--lowwater'), 'lowWater', 0.5) # resume reading once it drains to this
     ) # proxy listens on port 50000 by default and forwards to 127.0.0.1:50001
 
 #Parses command-line arguments according to the defined switches
@@ -24,6 +39,20 @@ progname = "stammerProxy"
 paramMap = params.parseParams(switchesVarDefaults)
 #Extracts parameters from the parsed command-line arguments
 server, listenPort, usage, debug, pauseDelay = paramMap["server"], paramMap["listenPort"], paramMap["usage"], paramMap["debug"], float(paramMap["pauseDelay"])
+mode = paramMap["mode"]
+
+PROFILES = { # latency and jitter in s, rate in bytes/s, buffers must hold rate * latency to keep the rate
+    "stammer": dict(randomChunk=1, pause=pauseDelay), # random split of what is buffered, then a pause
+    "pass": dict(), # as fast as possible
+    "lan": dict(latency=0.0005, jitter=0.0002, rate=125e6, chunk=1448),
+    "wan": dict(latency=0.040, jitter=0.005, rate=12.5e6, chunk=1448, bufCap=1 << 20),
+    "mobile": dict(latency=0.080, jitter=0.030, rate=1.25e6, chunk=1448, stallChance=0.0005, stallTime=0.5, bufCap=256 << 10),
+    "satellite": dict(latency=0.300, jitter=0.010, rate=2.5e6, chunk=1448, bufCap=1 << 20),
+    }
+
+if mode not in PROFILES:
+    print("Unknown mode '%s' (%s)" % (mode, ", ".join(PROFILES)))
+    sys.exit(1)
 
 if usage: # Shows usage information if requested.
     params.usage()
@@ -41,63 +70,175 @@ except:
     print("Can't parse listen port from %s" % listenPort)
     sys.exit(1)
 
-print ("%s: listening on %s, will forward to %s\n" % 
-       (progname, listenPort, server)) #Displays the proxy's configuration
+try: #Starts from the profile and applies whatever was given on the command line
+    profile = dict(latency=0, jitter=0, rate=0, chunk=0, randomChunk=0, pause=0, stallChance=0, stallTime=0, bufCap=65536)
+    profile.update(PROFILES[mode])
+    if paramMap["latency"] != "profile": profile["latency"] = float(paramMap["latency"]) / 1000
+    if paramMap["jitter"] != "profile": profile["jitter"] = float(paramMap["jitter"]) / 1000
+    if paramMap["rate"] != "profile": profile["rate"] = float(paramMap["rate"])
+    if paramMap["chunk"] != "profile": profile["chunk"] = int(paramMap["chunk"])
+    if paramMap["stall"] != "profile":
+        chance, stallTime = paramMap["stall"].split(":")
+        profile["stallChance"], profile["stallTime"] = float(chance), float(stallTime)
+    if paramMap["bufCap"] != "profile": profile["bufCap"] = int(paramMap["bufCap"])
+except:
+    print("Can't parse the impairment switches")
+    sys.exit(1)
+latency, jitter, rate, chunk = profile["latency"], profile["jitter"], profile["rate"], profile["chunk"]
+randomChunk, pause, stallChance, stallTime = profile["randomChunk"], profile["pause"], profile["stallChance"], profile["stallTime"]
+
+seed = paramMap["seed"]
+if seed == "random": # pick one, and print it so the run can be repeated with -S
+    seed = random.randrange(1 << 32)
+
+try: #Watermarks are fractions of the buffer; reading stops at the high one and resumes at the low one
+    bufCap = int(profile["bufCap"])
+    highWater = max(1, min(bufCap, int(bufCap * float(paramMap["highWater"]))))
+    lowWater = min(highWater - 1, int(bufCap * float(paramMap["lowWater"])))
+    assert bufCap > 0
+except:
+    print("Can't parse buffer size and watermarks")
+    sys.exit(1)
+
+print ("%s: listening on %s, will forward to %s (%s mode, %d byte buffers, seed %s)" %
+       (progname, listenPort, server, mode, bufCap, seed)) #Displays the proxy's configuration
+print ("  latency %gms +/- %gms, rate %s, chunk %s, pause %gs, stall chance %g for %gs\n" %
+       (latency * 1000, jitter * 1000, "%g B/s" % rate if rate else "unlimited",
+        ("random up to %s" if randomChunk else "%s") % (chunk or "all"), pause, stallChance, stallTime))
 
 #Initializes global variables to track sockets and connections
 sockNames = {}               # from socket to name
 nextConnectionNumber = 0     # each connection is assigned a unique id
 now = time.time()
+sel = selectors.DefaultSelector()   # sockets stay registered; interest changes only when a forwarder's does
+timers = []                  # heap of (delaySendUntil, seq, forwarder) for paused sends
+timerSeq = itertools.count()
+
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE) # two descriptors per connection
+if soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
 #class to handle forwarding data between sockets
-class Fwd: #Each forwarder instance has: input/output socket, buffer & delay settings
-    def __init__(self, conn, inSock, outSock, bufCap = 1000):
-        global now
-        self.conn, self.inSock, self.outSock, self.bufCap = conn, inSock, outSock, bufCap
-        self.inClosed, self.buf = 0, bytes(0)
+class Fwd: #Each forwarder instance has: input/output socket, a ring buffer & the impairments' state
+    def __init__(self, conn, inSock, outSock, direction):
+        self.conn, self.inSock, self.outSock, self.direction = conn, inSock, outSock, direction
+        self.buf = None # ring: `count` bytes starting at `head`, wrapping at bufCap; allocated on first use
+        self.head, self.count = 0, 0
+        self.inClosed, self.reading = 0, 1 # reading drops at highWater and comes back at lowWater
         self.delaySendUntil = 0 # no delay
+        self.rng = random.Random("%s:%d:%s" % (seed, conn.connIndex, direction)) # same choices on replay, whatever the interleaving
+        self.marks = deque() # (received total at the end of a read, when that read may be sent) under latency
+        self.received = self.sent = 0 # totals
+        self.paceAt = 0 # when the rate allows the next send
+        self.started, self.latencyTotal, self.held, self.stalls = time.time(), 0.0, 0.0, 0 # for the report
+    def freeViews(self): # the free space as at most two views, in order
+        if self.buf is None: # idle connections cost no buffer space
+            self.buf = memoryview(bytearray(bufCap))
+        tail = (self.head + self.count) % bufCap
+        if tail < self.head or self.count == bufCap:
+            return [self.buf[tail:self.head]]
+        return [v for v in (self.buf[tail:], self.buf[:self.head]) if len(v)]
+    def dataViews(self, n): # the first n buffered bytes as at most two views, in order
+        end = self.head + n
+        if end <= bufCap:
+            return [self.buf[self.head:end]]
+        return [self.buf[self.head:], self.buf[:end - bufCap]]
+    def due(self): # buffered bytes whose latency has passed
+        marks = self.marks
+        while marks and marks[0][0] <= self.sent:
+            marks.popleft()
+        if not latency and not jitter:
+            return self.count
+        end = self.sent
+        for upTo, releaseAt in marks:
+            if releaseAt > now:
+                break
+            end = upTo
+        return end - self.sent
+    def delay(self, until): # hold sends until `until`, waking the loop then
+        if until > self.delaySendUntil:
+            self.delaySendUntil = until
+            heapq.heappush(timers, (until, next(timerSeq), self))
     def checkRead(self): #determine if a socket should be monitored for reading or writing
-        if len(self.buf) < self.bufCap and not self.inClosed:
+        if self.reading and not self.inClosed:
             return self.inSock
-        else: #Only reads if the buffer has space and the input socket is open
+        else: #Only reads below the high watermark and while the input socket is open
             return None
     def checkWrite(self):
-        if len(self.buf) > 0 and now >= self.delaySendUntil:
+        if self.count > 0 and now >= self.delaySendUntil and self.due():
             return self.outSock
-        else:#Only writes if there's data in the buffer and any configured delay has expired
+        else:#Only writes if there's data due in the buffer and any configured delay has expired
             return None
-    def doRecv(self): #Receive data from input socket & add it in to buffer
+    def doRecv(self): #Receive data from input socket straight into the ring's free space
         try:
-            b = self.inSock.recv(self.bufCap - len(self.buf))
+            n = self.inSock.recvmsg_into(self.freeViews())[0]
+        except BlockingIOError:
+            return
         except:
             self.conn.die()
             return
-        if len(b):
-            self.buf += b
+        if n:
+            self.count += n
+            self.received += n
+            if self.count >= highWater:
+                self.reading = 0
+            if latency or jitter: # delivery times never go backwards: it is a byte stream
+                releaseAt = now + max(0, latency + self.rng.uniform(-jitter, jitter))
+                if self.marks:
+                    releaseAt = max(releaseAt, self.marks[-1][1])
+                self.marks.append((self.received, releaseAt))
+                self.latencyTotal += (releaseAt - now) * n
+                heapq.heappush(timers, (releaseAt, next(timerSeq), self))
         else:
             self.inClosed = 1
         self.checkDone() #Marks the input as closed if no data is received (EOF)
-    def doSend(self): #simulates network conditions that break up messages into unpredictable chunks
-        global now
-        try: #sends a random portion of the buffer rather than all at once
-            bufLen = len(self.buf)
-            toSend = random.randrange(1, bufLen+1)
-            if debug: print("attempting to send %d of %d" % (toSend, len(self.buf)))
-            n = self.outSock.send(self.buf[0:toSend])
-            self.buf = self.buf[n:]
-            if len(self.buf): #After sending, it adds a delay before the next send operation
-                self.delaySendUntil = now + pauseDelay
+    def doSend(self): #sends what is due, cut to the profile's chunk size, then applies its pauses
+        n = self.due()
+        if not n: # a stale write event: nothing is due yet
+            return
+        if chunk:
+            n = min(n, chunk)
+        if randomChunk: #sends a random portion rather than all at once
+            n = self.rng.randrange(1, n+1)
+        if debug: print("attempting to send %d of %d" % (n, self.count))
+        try:
+            n = self.outSock.sendmsg(self.dataViews(n))
+        except BlockingIOError:
+            return
         except Exception as e:
             print(e)
             self.conn.die()
+            return
+        self.head, self.count = (self.head + n) % bufCap, self.count - n
+        self.sent += n
+        if self.count <= lowWater:
+            self.reading = 1
+        until = now
+        if rate: # a clock running n/rate ahead per send; it restarts after an idle spell
+            self.paceAt = max(self.paceAt, now - 0.05) + n / rate
+            until = max(until, self.paceAt)
+        if pause and self.count: #After sending, it adds a delay before the next send operation
+            until = max(until, now + pause)
+        if stallChance and self.rng.random() < stallChance:
+            until = max(until, now + stallTime)
+            self.stalls += 1
+        if until > now:
+            self.held += until - max(now, self.delaySendUntil)
+            self.delay(until)
         self.checkDone()
-        
+
     def checkDone(self): #Checks if forwarding is complete (buffer empty and input closed)
-        if len(self.buf) == 0 and self.inClosed:
+        if self.count == 0 and self.inClosed:
             self.outSock.shutdown(SHUT_WR)
             self.conn.fwdDone(self) #If done, it signals end of transmission & notifies connection
-            
-    
+
+    def report(self): #What this direction delivered and how much the impairments held it back
+        elapsed = time.time() - self.started
+        print("C%d %s: %d bytes in %.3fs (%.1f KB/s), latency added %.1fms mean, held %.3fs by pauses, rate and %d stalls" %
+              (self.conn.connIndex, self.direction, self.sent, elapsed, self.sent / elapsed / 1000 if elapsed else 0,
+               self.latencyTotal / self.received * 1000 if self.received else 0, self.held, self.stalls))
+
+
 connections = set() #track all active connections
 
 class Conn: #Handles a connection between a client and server
@@ -107,38 +248,72 @@ class Conn: #Handles a connection between a client and server
         self.caddr, self.saddr = caddr, saddr # addresses
         self.connIndex = connIndex = nextConnectionNumber
         nextConnectionNumber += 1
+        csock.setblocking(False) # accepted sockets start out blocking whatever the listener is
         self.ssock = ssock = socket(af, socktype)
         self.forwarders = forwarders = set()
+        self.events = {csock: 0, ssock: 0} # what each socket is registered for
         print("New connection #%d from %s" % (connIndex, repr(caddr)))
         sockNames[csock] = "C%d:ToClient" % connIndex #Assigns names to sockets for debugging purposes
         sockNames[ssock] = "C%d:ToServer" % connIndex
         ssock.setblocking(False) #Sets up a non-blocking connection to destination server
         ssock.connect_ex(saddr)
-        forwarders.add(Fwd(self, csock, ssock)) #Creates two forwarders:one from client to server
-        forwarders.add(Fwd(self, ssock, csock))#and one from server to client
+        forwarders.add(Fwd(self, csock, ssock, "client->server")) #Creates two forwarders:one from client to server
+        forwarders.add(Fwd(self, ssock, csock, "server->client"))#and one from server to client
         connections.add(self)
-        
+        self.watch(csock)
+        self.watch(ssock)
+
+    def watch(self, sock): #Brings the socket's registration in line with what its forwarders want
+        events = 0
+        for fwd in self.forwarders:
+            if fwd.checkRead() is sock: events |= EVENT_READ
+            if fwd.checkWrite() is sock: events |= EVENT_WRITE
+        old = self.events[sock]
+        if events == old:
+            return
+        if not old:
+            sel.register(sock, events, self)
+        elif not events:
+            sel.unregister(sock)
+        else:
+            sel.modify(sock, events, self)
+        self.events[sock] = events
+
+    def doEvents(self, sock, events): #Runs the forwarders the ready socket feeds or drains
+        for fwd in list(self.forwarders):
+            if self not in connections:
+                return
+            if events & EVENT_READ and fwd.inSock is sock: fwd.doRecv()
+            elif events & EVENT_WRITE and fwd.outSock is sock: fwd.doSend()
+        if self in connections:
+            self.watch(self.csock)
+            self.watch(self.ssock)
+
     def fwdDone(self, forwarder): #Removes a completed forwarder
         forwarders = self.forwarders
         forwarders.remove(forwarder)
+        forwarder.report()
         print("forwarder %s ==> %s from connection %d shutting down" % (sockNames[forwarder.inSock], sockNames[forwarder.outSock], self.connIndex))
         if len(forwarders) == 0:
             self.die() #If all forwarders are done, terminates the connection
             
     def die(self): #Cleans up a connection by closing sockets and removing references
+        if self not in connections: # already gone; a later ready socket of ours can land here again
+            return
         print("connection %d shutting down" % self.connIndex)
+        for fwd in self.forwarders: # cut off before finishing
+            fwd.report()
         for s in self.ssock, self.csock:
+            if self.events[s]:
+                sel.unregister(s)
             del sockNames[s]
             try:
                 s.close()
             except:
                 pass 
         connections.remove(self)
+        l.resume()
         
-    def doErr(self): #Cleans up a connection by closing sockets and removing references
-        print("forwarder from client %s failing due to error" % repr(self.caddr))
-        die()
-                
 class Listener: #Listens for incoming connections and creates a new connection object for each
     def __init__(self, bindaddr, saddr, addrFamily=AF_INET, socktype=SOCK_STREAM): # saddr is address of server
         self.bindaddr, self.saddr = bindaddr, saddr
@@ -148,56 +323,48 @@ class Listener: #Listens for incoming connections and creates a new connection o
         lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         lsock.bind(bindaddr)
         lsock.setblocking(False) #non-blocking socket with address reuse enabled
-        lsock.listen(2)
-    def doRecv(self): #Accepts new client connection & creates a Conn object to handle it
-        try:
-            csock, caddr = self.lsock.accept() # socket connected to client
-            conn = Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
-        except:
-            print("weird.  listener readable but can't accept!")
-            traceback.print_exc(file=sys.stdout)
-            
-    def doErr(self):#Handles errors with the listener socket by exiting the program
-        print("listener socket failed!!!!!")
-        sys.exit(2)
-# Methods to indicate which socket should be monitored for reading, writing, and errors
-    def checkRead(self):
-        return self.lsock
-    def checkWrite(self):
-        return None
-    def checkErr(self):
-        return self.lsock
-        
+        lsock.listen(SOMAXCONN)
+        sel.register(lsock, EVENT_READ, self)
+        self.paused = 0
+    def resume(self): #A connection closed, so there may be descriptors to accept with again
+        if self.paused:
+            sel.register(self.lsock, EVENT_READ, self)
+            self.paused = 0
+    def doEvents(self, sock, events): #Accepts every waiting client & creates a Conn object for each
+        while 1:
+            try:
+                csock, caddr = self.lsock.accept() # socket connected to client
+            except BlockingIOError:
+                return
+            except OSError as e: # out of descriptors: leave the rest in the backlog until a connection closes
+                print("listener readable but can't accept: %s" % e)
+                if not self.paused:
+                    sel.unregister(self.lsock)
+                    self.paused = 1
+                return
+            try:
+                conn = Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
+            except:
+                print("weird.  can't set up forwarding for %s!" % repr(caddr))
+                traceback.print_exc(file=sys.stdout)
+                csock.close()
+
 #Creates a listener that forwards connections to the target server
 l = Listener(("0.0.0.0", listenPort), (serverHost, serverPort))
 #Helper function to convert socket objects to their names for debugging
 def lookupSocknames(socks):
-    return [ sockName(s) for s in socks ]
+    return [ sockNames[s] for s in socks ]
 
-while 1: #Main event loop that sets up maps for select() to monitor socket activity
-    rmap,wmap,xmap = {},{},{}   # socket:object mappings for select
-    xmap[l.checkErr()] = l #listener is monitored for both reading and errors
-    rmap[l.checkRead()] = l
+while 1: #Main event loop: wait for ready sockets or the earliest paused send, whichever comes first
+    now = time.time()
+    maxSleep = max(0, timers[0][0] - now) if timers else None
+    if debug: print("select max sleep=%s" % maxSleep)
+    ready = sel.select(maxSleep)
+    if debug: print(repr(lookupSocknames([ key.fileobj for key, events in ready ])))
     now = time.time()
-    nextDelayUntil = now + 10   # default 10s poll
-    for conn in connections: #Iterates through all active connections to check their status
-        for sock in conn.csock, conn.ssock:
-            xmap[sock] = conn
-            for fwd in conn.forwarders: #Calculates next send delay to optimize the select() timeout
-                sock = fwd.checkRead()
-                if (sock): rmap[sock] = fwd
-                sock = fwd.checkWrite()
-                if (sock): wmap[sock] = fwd
-                delayUntil = fwd.delaySendUntil
-                if (delayUntil < nextDelayUntil and delayUntil > now): # minimum active delay
-                    nextDelayUntil = delayUntil
-    maxSleep = nextDelayUntil - now #Uses select() to efficiently wait for socket activity or until the next delay expires
-    if debug: print("select max sleep=%fs" % maxSleep)
-    rset, wset, xset = select(list(rmap.keys()), list(wmap.keys()), list(xmap.keys()), maxSleep)
-    if debug: print([ repr([ sockNames[s] for s in sset]) for sset in [rset,wset,xset] ])
-    for sock in rset: #Handles ready sockets by calling the appropriate methods on their associated objects
-        rmap[sock].doRecv()
-    for sock in wset:
-        wmap[sock].doSend()
-    for sock in xset:
-        xmap[sock].doErr()
\ No newline at end of file
+    for key, events in ready: #Hands ready sockets to the object registered with them
+        key.data.doEvents(key.fileobj, events)
+    while timers and timers[0][0] <= now: #Paused sends that may go now
+        when, seq, fwd = heapq.heappop(timers)
+        if fwd.conn in connections and fwd in fwd.conn.forwarders:
+            fwd.conn.watch(fwd.outSock)
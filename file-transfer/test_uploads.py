@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+
+# Concurrent uploads of one name against each server: a second PUT while the
+# first is still streaming must be refused, and whatever ends up stored (and
+# its digest sidecar) must be exactly one client's upload. Names that clash
+# with stored directories or files must get an error reply, not a dropped
+# connection.
+#
+#   python -m pytest test_uploads.py      or      ./test_uploads.py
+
+import hashlib, os, shutil, socket, subprocess, sys, tempfile, threading, time
+import framing
+import framedThreadClient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIB = os.path.join(HERE, "..", "lib")
+SIZE = 8 * 1024 * 1024 + 5
+
+def server_command(mode, port):
+    if mode == "thread":
+        return [sys.executable, "-c", f"import sys; sys.path.insert(0, {HERE!r}); "
+                f"import framedThreadServer as s; s.PORT = {port}; s.METRICS_PORT = 0; s.main()"]
+    script = "framedSelectServer.py" if mode == "select" else "framedAsyncServer.py"
+    return [sys.executable, os.path.join(HERE, script), "-l", str(port), "-m", "0"]
+
+class Server: # one server in a scratch directory, for the length of a with block
+    def __init__(self, mode):
+        self.mode = mode
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            self.port = s.getsockname()[1]
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix="ft-test-")
+        env = dict(os.environ, PYTHONPATH=LIB)
+        self.proc = subprocess.Popen(server_command(self.mode, self.port), cwd=self.dir, env=env,
+                                     stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or self.proc.poll() is not None:
+                    self.__exit__()
+                    raise RuntimeError(f"{self.mode} server didn't start")
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def connect(self): # a reply that never comes fails the test rather than hanging it
+        return socket.create_connection(("localhost", self.port), timeout=30)
+
+    def stored(self, name): # (file contents, sidecar digest)
+        with open(os.path.join(self.dir, "server-files", name), "rb") as f:
+            data = f.read()
+        with open(os.path.join(self.dir, "server-meta", name)) as f:
+            return data, f.read().split()[1]
+
+def put(sock, name, data): # the whole upload; returns the server's reply
+    framing.send_framed(sock, f"PUT {name}".encode())
+    sock.sendall(framing.stream_header(len(data)))
+    first = data[:framing.CHUNK_SIZE]
+    sock.sendall(framing.chunk_header(len(first)) + first)
+    _rest(sock, data)
+    return bytes(framing.recv_framed(sock))
+
+def _rest(sock, data): # the chunks after the first, and the end of the stream
+    for offset in range(framing.CHUNK_SIZE, len(data), framing.CHUNK_SIZE):
+        chunk = data[offset:offset + framing.CHUNK_SIZE]
+        sock.sendall(framing.chunk_header(len(chunk)) + chunk)
+    sock.sendall(framing.END_OF_STREAM)
+
+def check_overlapping_put_refused(mode):
+    first, second = os.urandom(SIZE), os.urandom(SIZE)
+    with Server(mode) as server, server.connect() as a, server.connect() as b:
+        framing.send_framed(a, b"PUT same.bin")
+        a.sendall(framing.stream_header(len(first)))
+        a.sendall(framing.chunk_header(framing.CHUNK_SIZE) + first[:framing.CHUNK_SIZE])
+        time.sleep(0.3) # the first upload has its partial file open by now
+        assert put(b, "same.bin", second) == b"ERROR: Upload already in progress"
+        _rest(a, first)
+        assert bytes(framing.recv_framed(a)) == b"Upload successful"
+        data, digest = server.stored("same.bin")
+        assert data == first and digest == hashlib.sha256(first).hexdigest()
+        assert put(b, "same.bin", second) == b"Upload successful" # the lock went with the first upload
+        data, digest = server.stored("same.bin")
+        assert data == second and digest == hashlib.sha256(second).hexdigest()
+
+def check_racing_puts_store_one(mode, rounds=3):
+    with Server(mode) as server:
+        for _ in range(rounds):
+            bodies = [os.urandom(SIZE), os.urandom(SIZE)]
+            replies = [None, None]
+            def one(i):
+                with server.connect() as sock:
+                    replies[i] = put(sock, "same.bin", bodies[i])
+            threads = [threading.Thread(target=one, args=(i,)) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert set(replies) <= {b"Upload successful", b"ERROR: Upload already in progress"}, replies
+            winners = [body for body, reply in zip(bodies, replies) if reply == b"Upload successful"]
+            data, digest = server.stored("same.bin")
+            assert winners and data in winners
+            assert digest == hashlib.sha256(data).hexdigest()
+
+def check_clashing_names_answered(mode):
+    with Server(mode) as server, server.connect() as sock:
+        assert put(sock, "d1/d2/x.txt", b"small") == b"Upload successful"
+        path = os.path.join(server.dir, "big.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(2 * framing.CHUNK_SIZE + 5)) # over a chunk: the client asks RESUME d1 first
+        assert framedThreadClient.put_file(sock, path, name="d1") == "ERROR: Name clashes with a stored file or directory"
+        framing.send_framed(sock, b"SUMS d1/d2/x.txt/zz") # runs through a stored file
+        assert bytes(framing.recv_framed(sock)) == b"ERROR: File not found"
+        with server.connect() as other: # leave an interrupted upload's partial file behind
+            framing.send_framed(other, b"PUT p")
+            other.sendall(framing.stream_header(SIZE))
+            other.sendall(framing.chunk_header(framing.CHUNK_SIZE) + bytes(framing.CHUNK_SIZE))
+            time.sleep(0.3)
+        framing.send_framed(sock, b"RESUME p/q") # runs through that partial file
+        assert bytes(framing.recv_framed(sock)) == b"ERROR: No partial upload"
+        framing.send_framed(sock, b"RESUME d1") # a directory of partial files
+        assert bytes(framing.recv_framed(sock)) == b"ERROR: No partial upload"
+
+def test_overlapping_put_refused_thread():
+    check_overlapping_put_refused("thread")
+
+def test_overlapping_put_refused_select():
+    check_overlapping_put_refused("select")
+
+def test_overlapping_put_refused_async():
+    check_overlapping_put_refused("async")
+
+def test_racing_puts_store_one_thread():
+    check_racing_puts_store_one("thread")
+
+def test_racing_puts_store_one_select():
+    check_racing_puts_store_one("select")
+
+def test_racing_puts_store_one_async():
+    check_racing_puts_store_one("async")
+
+def test_clashing_names_answered_thread():
+    check_clashing_names_answered("thread")
+
+def test_clashing_names_answered_select():
+    check_clashing_names_answered("select")
+
+def test_clashing_names_answered_async():
+    check_clashing_names_answered("async")
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+
+# Mirrors a directory tree to (push) or from (pull) a file transfer server.
+#
+# Both sides describe their tree as a manifest (manifest.py). The server
+# answers MANIFEST from its digest sidecars; the client scans its own tree and
+# hashes only files whose size or mtime changed since the last sync, keeping
+# the digests in STATE_FILE at the top of the local tree. Comparing the two
+# locally gives the files to send: missing on the other side, a different
+# size, or a different digest. Those go through a clientPool with -j
+# connections, biggest first, under a progress line. Files that exist only on
+# the receiving side are left alone, the protocol has no delete. Paths from
+# the server are checked with framing.safe_path, and a pull never writes
+# through a local symlink that leads out of the tree.
+#
+#   ./treeSync.py -s localhost:50001 -d push -l photos -r photos
+
+import io, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from framing import recv_stream, safe_path, hash_file
+import manifest
+import clientPool
+import framedThreadClient as client
+
+switchesVarDefaults = (
+    (('-s', '--server'), 'server', "localhost:50000"),
+    (('-d', '--direction'), 'direction', "push"), # push: the local tree to the server; pull: the server's to local
+    (('-l', '--local'), 'local', "."), # local directory
+    (('-r', '--remote'), 'remote', "."), # directory in the server's store, "." for the whole store
+    (('-j', '--jobs'), 'jobs', 8), # transfers in flight, each on its own connection
+    (('-n', '--dryrun'), 'dryRun', False), # boolean: list what would be sent, send nothing
+    (('-?', '--usage'), "usage", False), # boolean (set if present)
+    )
+
+STATE_FILE = ".ftsync"  # local digests from the last sync, as a manifest
+RACY_WINDOW = 1.0       # seconds; a file changed this close to its hashing isn't trusted next time (as in dirCache)
+JOBS = 8
+PROGRESS_INTERVAL = 0.5 # seconds between progress line updates
+
+def load_state(root): # {path: (size, mtime_ns, digest)} recorded by the last sync, {} if none
+    try:
+        with open(os.path.join(root, STATE_FILE), "rb") as f:
+            return manifest.decode(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def save_state(root, entries, racy): # racy: paths whose digest may not survive a change in the same mtime tick
+    path = os.path.join(root, STATE_FILE)
+    with open(path + ".tmp", "wb") as f:
+        f.write(manifest.encode((name, size, mtime_ns, digest) for name, (size, mtime_ns, digest) in entries.items()
+                                if digest is not None and name not in racy))
+    os.replace(path + ".tmp", path)
+
+def scan_local(root): # {path: (size, mtime_ns, digest or None)}, digests carried over while size and mtime match
+    state = load_state(root)
+    local = {}
+    for path, st in manifest.scan(root):
+        if path in (STATE_FILE, STATE_FILE + ".tmp"):
+            continue
+        known = state.get(path)
+        digest = known[2] if known is not None and known[:2] == (st.st_size, st.st_mtime_ns) else None
+        local[path] = (st.st_size, st.st_mtime_ns, digest)
+    return local
+
+def fetch_remote(pool, remote): # the server's manifest of remote, {} if there is no such directory yet
+    def job(conn):
+        client.send_request(conn.sock, "MANIFEST", [remote] if remote else [])
+        status = client.recv_reply(conn.sock)
+        if status.startswith(b"ERROR: No such directory"):
+            return {}
+        if not status.startswith(b"OK"): # an older server answers "Unknown or malformed command"
+            raise ValueError(f"MANIFEST refused: {status.decode()}")
+        body = io.BytesIO()
+        if recv_stream(conn.sock, body) is None:
+            raise ConnectionError("manifest interrupted")
+        return manifest.decode(body.getbuffer())
+    return pool.run(job)
+
+def hash_local(root, local, paths, executor, racy): # fills in the missing digests of paths, several files at once
+    def one(path):
+        hashed = time.time_ns()
+        try:
+            with open(os.path.join(root, path), "rb") as f:
+                return path, hash_file(f).hexdigest(), hashed
+        except OSError:
+            return path, None, hashed
+    for path, digest, hashed in executor.map(one, [path for path in paths if local[path][2] is None]):
+        size, mtime_ns, _ = local[path]
+        local[path] = (size, mtime_ns, digest)
+        if mtime_ns > hashed - RACY_WINDOW * 1e9:
+            racy.add(path)
+
+def plan(source, dest, hash_missing): # paths of source to send: missing at dest, or different there
+    # hash_missing fills in local digests in place; only files the same size on both sides need one
+    hash_missing([path for path, entry in source.items() if path in dest and dest[path][0] == entry[0]])
+    changes = []
+    for path, (size, mtime_ns, digest) in source.items():
+        there = dest.get(path)
+        if there is None or there[0] != size or digest is None or digest != there[2]:
+            changes.append(path)
+    return changes
+
+def inside(root, path): # root/path for writing, None if a symlinked directory on the way leads out of root
+    target = os.path.join(root, path)
+    real_root = os.path.realpath(root)
+    if os.path.commonpath([real_root, os.path.realpath(os.path.dirname(target))]) != real_root:
+        return None
+    return target
+
+class Progress: # files and bytes done out of the planned total, redrawn on one line
+    def __init__(self, files, total, out):
+        self.files, self.total, self.out = files, total, out
+        self.done_files = self.done_bytes = self.failed = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self._draw_every, daemon=True)
+        self.thread.start()
+
+    def done(self, size, ok):
+        with self.lock:
+            self.done_files += 1
+            self.done_bytes += size
+            self.failed += not ok
+
+    def line(self):
+        with self.lock:
+            files, moved, failed = self.done_files, self.done_bytes, self.failed
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        filled = int(20 * moved / self.total) if self.total else 20
+        rate = moved / elapsed
+        eta = (self.total - moved) / rate if rate else 0
+        return (f"[{'#' * filled}{'.' * (20 - filled)}] {files}/{self.files} files  "
+                f"{moved / (1 << 20):.1f}/{self.total / (1 << 20):.1f} MiB  {rate / (1 << 20):.1f} MiB/s  "
+                f"eta {eta:.0f}s" + (f"  {failed} failed" if failed else ""))
+
+    def _draw_every(self):
+        while not self.finished.wait(PROGRESS_INTERVAL):
+            print("\r" + self.line(), end="", file=self.out, flush=True)
+
+    def close(self):
+        self.finished.set()
+        self.thread.join()
+        print("\r" + self.line(), file=self.out, flush=True)
+
+def sync(server, direction, local_root, remote="", jobs=JOBS, dry_run=False, out=sys.stdout): # returns the failures
+    remote = remote.strip("/")
+    remote = "" if remote == "." else remote
+    if remote and not safe_path(remote):
+        raise ValueError(f"bad remote directory {remote!r}")
+    started = time.time()
+    os.makedirs(local_root, exist_ok=True)
+    pool = clientPool.ConnectionPool([server], max_per_host=jobs)
+    with pool, ThreadPoolExecutor(jobs) as executor:
+        local = scan_local(local_root)
+        remote_files = fetch_remote(pool, remote)
+        unsafe = [path for path in remote_files if not safe_path(path)] # a server's paths are untrusted too
+        for path in unsafe:
+            del remote_files[path]
+        racy = set()
+        hash_missing = lambda paths: hash_local(local_root, local, paths, executor, racy)
+        source, dest = (local, remote_files) if direction == "push" else (remote_files, local)
+        changes = plan(source, dest, hash_missing)
+        sizes = {path: source[path][0] for path in changes}
+        total = sum(sizes.values())
+        scanned = time.time() - started
+        print(f"[*] {len(local)} local, {len(remote_files)} remote files compared in {scanned:.2f}s: "
+              f"{len(changes)} to {direction} ({total / (1 << 20):.1f} MiB)", file=out)
+        if unsafe:
+            print(f"[!] ignored {len(unsafe)} server paths that would leave the tree, e.g. {unsafe[0]!r}", file=out)
+        extra = len(set(dest) - set(source))
+        if extra:
+            print(f"[*] {extra} files only on the {'server' if direction == 'push' else 'local'} side left alone", file=out)
+        if dry_run:
+            for path in sorted(changes):
+                print(f"    {path}", file=out)
+            return []
+        failures = []
+        progress = Progress(len(changes), total, out)
+        def one(path):
+            name = f"{remote}/{path}" if remote else path
+            try:
+                if direction == "push":
+                    message = pool.put_from_file(os.path.join(local_root, path), name)
+                    ok = message.startswith("Upload successful")
+                else:
+                    target = inside(local_root, path)
+                    if target is None:
+                        message, ok = "ERROR: Path leads out of the tree through a symlink", False
+                    else:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        message = pool.get_to_file(name, target, False) # planned because it differs
+                        ok = message == "File downloaded."
+                        if ok: # downloads are checked against this digest, so it is the file's
+                            st = os.stat(target)
+                            local[path] = (st.st_size, st.st_mtime_ns, source[path][2])
+            except (OSError, ValueError) as e:
+                message, ok = f"ERROR: {e}", False
+            if not ok:
+                failures.append((path, message))
+            progress.done(sizes[path], ok)
+        for path in sorted(changes, key=lambda path: -sizes[path]): # big ones first, small ones fill in around them
+            executor.submit(one, path)
+        executor.shutdown(wait=True)
+        progress.close()
+    save_state(local_root, local, racy)
+    for path, message in failures:
+        print(f"[!] {path}: {message}", file=out)
+    return failures
+
+def main():
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap['usage'] or paramMap['direction'] not in ("push", "pull"):
+        params.usage()
+    failures = sync(paramMap['server'], paramMap['direction'], paramMap['local'], paramMap['remote'],
+                    int(paramMap['jobs']), paramMap['dryRun'])
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__": # params is only for the command line: importing it consumes sys.argv
+    sys.path.append("../lib")       # for params
+    import params
+    main()